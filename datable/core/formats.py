@@ -2,24 +2,35 @@ JSON = 0
 XLS = 1
 CSV = 2
 HTML = 3
+XLSX = 4
 
 _extensions = {
     XLS: 'xls',
     CSV: 'csv',
-    HTML: 'html'
+    HTML: 'html',
+    XLSX: 'xlsx'
 }
 
 
 _mimetypes = {
     XLS: 'application/vnd.ms-excel',
     CSV: 'text/csv',
-    HTML: 'text/html'
+    HTML: 'text/html',
+    XLSX: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 }
 
 class UnknownFormat(Exception):
     pass
 
 
+def getFormat(extension):
+    """The format with extension; raises UnknownFormat."""
+    for output, value in _extensions.items():
+        if value == extension:
+            return output
+    raise UnknownFormat(extension)
+
+
 def getExtension(output):
     return _extensions.get(output)
 
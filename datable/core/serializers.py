@@ -3,10 +3,98 @@
 from django.core.urlresolvers import reverse
 
 from django.utils.translation import ugettext as _
+try:
+    from django.utils.timezone import localtime
+except ImportError:
+    # Django < 1.4: no time zone support
+    localtime = None
 from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+import re
 from datable.core import formats
 
-class UnicodeSerializer:
+def getSelectRelated(serializer):
+    """Relations, which serializer follows using a ForeignKey
+    (they should be joined with QuerySet.select_related)."""
+    fun = getattr(serializer, 'getSelectRelated', None)
+    if fun is None:
+        return []
+    return fun()
+
+
+def getRequiredFields(serializer):
+    """Model fields, which serializer reads (suitable for QuerySet.only),
+    or None if they are not known."""
+    fun = getattr(serializer, 'getRequiredFields', None)
+    if fun is None:
+        return None
+    return fun()
+
+
+def getPrefetchRelated(serializer):
+    """Relations, which serializer reads as a set of objects
+    (they should be fetched with QuerySet.prefetch_related)."""
+    fun = getattr(serializer, 'getPrefetchRelated', None)
+    if fun is None:
+        return []
+    return fun()
+
+
+def serializeColumn(serializer, models, output_format=None):
+    """Serialize a list of models with serializer, column-wise when
+    the serializer supports it."""
+    fun = getattr(serializer, 'serialize_column', None)
+    if fun is not None:
+        return fun(models, output_format)
+
+    serialize = serializer.serialize
+    return [serialize(model, output_format=output_format) for model in models]
+
+
+def nativeColumn(serializer, models, output_format=None):
+    """Values of a column for spreadsheets: numbers, dates and booleans
+    stay native values, when the serializer supports it (see
+    FieldSerializer.native_batch); other cells are serialized."""
+    fun = getattr(serializer, 'native_column', None)
+    if fun is not None:
+        result = fun(models)
+        if result is not None:
+            return result
+
+    return serializeColumn(serializer, models, output_format)
+
+
+def definedIn(klass, name):
+    """The class in klass' MRO, which defines attribute name."""
+    for base in klass.__mro__:
+        if name in base.__dict__:
+            return base
+
+
+class RelatedMixin:
+    """Custom serializers may set selectRelated and prefetchRelated
+    to declare relations they will read from the model, and
+    requiredFields to declare fields they read (None: unknown)."""
+
+    selectRelated = ()
+    prefetchRelated = ()
+    requiredFields = None
+
+    def getRequiredFields(self):
+        if self.requiredFields is None:
+            return None
+        return list(self.requiredFields)
+
+    def getSelectRelated(self):
+        return list(self.selectRelated)
+
+    def getPrefetchRelated(self):
+        return list(self.prefetchRelated)
+
+
+class UnicodeSerializer(RelatedMixin):
     def serialize(self, model, output_format=None):
         return str(model)
 
@@ -19,11 +107,18 @@ class DictProxy:
         return getattr(self.original, name
 
                        )
-class FormatStringSerializer:
+class FormatStringSerializer(RelatedMixin):
+
+    formatKeys = re.compile(r'%\(([^)]+)\)')
 
     def __init__(self, format):
         self.format = format
 
+    def getRequiredFields(self):
+        if type(self).asDict is not FormatStringSerializer.asDict:
+            return None
+        return self.formatKeys.findall(self.format.replace('%%', ''))
+
     def asDict(self, model):
         return DictProxy(model)
 
@@ -31,7 +126,7 @@ class FormatStringSerializer:
         return self.format % self.asDict(model)
 
 
-class FieldSerializer:
+class FieldSerializer(RelatedMixin):
     """I serialize single field of a single item to a specific
     format."""
 
@@ -48,6 +143,12 @@ class FieldSerializer:
     def extract_value(self, model):
         return self.getterFunction(model, self.field)
 
+    def getRequiredFields(self):
+        if self.getterFunction is not getattr or \
+           type(self).extract_value is not FieldSerializer.extract_value:
+            return None
+        return [self.field]
+
     def serialize_value(self, value, output_format=None):
         raise NotImplementedError
 
@@ -55,10 +156,60 @@ class FieldSerializer:
         return self.serialize_value(
             self.extract_value(model), output_format)
 
+    def serialize_batch(self, values, output_format=None):
+        """Serialize a list of values at once. Subclasses override this to
+        share work between cells; by default, serialize_value is called
+        for every value."""
+        serialize_value = self.serialize_value
+        return [serialize_value(value, output_format) for value in values]
+
+    def serialize_column(self, models, output_format=None):
+        """Serialize this field of every model of a list."""
+        klass = type(self)
+
+        if definedIn(klass, 'serialize') is not FieldSerializer:
+            # serialize was customized, it has to be called for every model
+            serialize = self.serialize
+            return [serialize(model, output_format=output_format)
+                    for model in models]
+
+        extract_value = self.extract_value
+        values = [extract_value(model) for model in models]
+
+        if not issubclass(definedIn(klass, 'serialize_batch'),
+                          definedIn(klass, 'serialize_value')):
+            # serialize_value was customized below serialize_batch
+            return FieldSerializer.serialize_batch(
+                self, values, output_format)
+
+        return self.serialize_batch(values, output_format)
+
+    def native_batch(self, values):
+        """Native values (numbers, dates, booleans or strings) of a list
+        of field values, for spreadsheets; None if there are none."""
+        return None
+
+    def native_column(self, models):
+        """native_batch of this field of every model of a list, or None
+        if serialization was customized below native_batch."""
+        klass = type(self)
+        native = definedIn(klass, 'native_batch')
+
+        if definedIn(klass, 'serialize') is not FieldSerializer or \
+           not issubclass(native, definedIn(klass, 'serialize_value')) or \
+           not issubclass(native, definedIn(klass, 'serialize_batch')):
+            return None
+
+        extract_value = self.extract_value
+        return self.native_batch([extract_value(model) for model in models])
+
     def getFieldName(self):
         return self.field
 
 
+numberTypes = (int, float, Decimal)
+
+
 class StringSerializer(FieldSerializer):
 
     def serialize_value(self, value, output_format=None):
@@ -67,6 +218,17 @@ class StringSerializer(FieldSerializer):
 
         return str(value)
 
+    def serialize_batch(self, values, output_format=None):
+        noData = _('[no data]')
+        return [noData if value is None else str(value) for value in values]
+
+    def native_batch(self, values):
+        noData = _('[no data]')
+        return [noData if value is None else
+                value if isinstance(value, numberTypes) and
+                not isinstance(value, bool) else str(value)
+                for value in values]
+
 
 class PrimaryKeySerializer(StringSerializer):
     def __init__(self):
@@ -80,13 +242,87 @@ class DateTimeSerializer(FieldSerializer):
 
         return value.strftime("%Y-%m-%d %H:%M:%S")
 
+    def serialize_batch(self, values, output_format=None):
+        noData = _('[no data]')
+        days = {}
+        result = []
+
+        for value in values:
+            if value is None:
+                result.append(noData)
+                continue
+
+            if not isinstance(value, datetime):
+                # A date, from a DateField
+                result.append(self.serialize_value(value, output_format))
+                continue
+
+            day = value.date()
+            dayString = days.get(day)
+            if dayString is None:
+                dayString = days[day] = day.strftime("%Y-%m-%d")
+
+            result.append("%s %02i:%02i:%02i" % (
+                dayString, value.hour, value.minute, value.second))
+
+        return result
+
+    def native_batch(self, values):
+        # As in serialize_value, the time zone is not converted
+        noData = _('[no data]')
+        result = []
+
+        for value in values:
+            if value is None:
+                value = noData
+            elif isinstance(value, datetime):
+                value = value.replace(tzinfo=None, microsecond=0)
+            result.append(value)
+
+        return result
+
+
+def getDay(value):
+    """The date of a date or a datetime; aware datetimes are converted to
+    the current time zone first, so the day is the one users see."""
+    if not isinstance(value, datetime):
+        return value
+
+    if value.tzinfo is not None and localtime is not None:
+        value = localtime(value)
+    return value.date()
+
 
 class DateSerializer(FieldSerializer):
     def serialize_value(self, value, output_format=None):
         if value is None:
             return _('[no data]')
 
-        return value.strftime("%Y-%m-%d")
+        return getDay(value).strftime("%Y-%m-%d")
+
+    def serialize_batch(self, values, output_format=None):
+        noData = _('[no data]')
+        days = {}
+        result = []
+
+        for value in values:
+            if value is None:
+                result.append(noData)
+                continue
+
+            value = getDay(value)
+            dayString = days.get(value)
+            if dayString is None:
+                dayString = days[value] = value.strftime("%Y-%m-%d")
+            result.append(dayString)
+
+        return result
+
+    def native_batch(self, values):
+        # Dates, as xlwt can not write aware datetimes
+        noData = _('[no data]')
+        return [noData if value is None else getDay(value)
+                for value in values]
 
 
 class BooleanSerializer(FieldSerializer):
@@ -99,6 +335,16 @@ class BooleanSerializer(FieldSerializer):
 
         return '-'
 
+    def serialize_batch(self, values, output_format=None):
+        noData = _('[no data]')
+        yes = _('yes')
+        return [noData if value is None else (yes if value else '-')
+                for value in values]
+
+    def native_batch(self, values):
+        noData = _('[no data]')
+        return [noData if value is None else bool(value) for value in values]
+
 
 class TimedeltaSerializer(FieldSerializer):
     def serialize_value(self, value, output_format=None):
@@ -110,6 +356,14 @@ class TimedeltaSerializer(FieldSerializer):
 
         return _("%.2f sec.") % total_seconds
 
+    def serialize_batch(self, values, output_format=None):
+        noData = _('[no data]')
+        label = _("%.2f sec.")
+        return [noData if value is None else label % (
+            value.days * 86400 + value.seconds +
+            value.microseconds / 1000000.0)
+                for value in values]
+
 
 class ForeignKeySerializer(FieldSerializer):
     def __init__(self, field, other_serializer, *args, **kw):
@@ -121,9 +375,53 @@ class ForeignKeySerializer(FieldSerializer):
         return self.other_serializer.serialize(
             other_model, output_format=output_format)
 
+    def serialize_batch(self, values, output_format=None):
+        return serializeColumn(self.other_serializer, values, output_format)
+
+    def native_column(self, models):
+        if definedIn(type(self), 'serialize') is not ForeignKeySerializer or \
+           definedIn(type(self), 'serialize_batch') is not \
+           ForeignKeySerializer:
+            return None
+
+        extract_value = self.extract_value
+        values = [extract_value(model) for model in models]
+
+        fun = getattr(self.other_serializer, 'native_column', None)
+        if fun is None:
+            return None
+        return fun(values)
+
+    def serialize_column(self, models, output_format=None):
+        if definedIn(type(self), 'serialize') is not ForeignKeySerializer:
+            serialize = self.serialize
+            return [serialize(model, output_format=output_format)
+                    for model in models]
+
+        extract_value = self.extract_value
+        return self.serialize_batch(
+            [extract_value(model) for model in models], output_format)
+
     def getFieldName(self):
         return self.field + "__" + self.other_serializer.getFieldName()
 
+    def getSelectRelated(self):
+        return FieldSerializer.getSelectRelated(self) + [self.field] + [
+            self.field + "__" + name
+            for name in getSelectRelated(self.other_serializer)]
+
+    def getRequiredFields(self):
+        mine = FieldSerializer.getRequiredFields(self)
+        other = getRequiredFields(self.other_serializer)
+        if mine is None or other is None:
+            return None
+        return mine + [self.field + "__" + name for name in other]
+
+    def getPrefetchRelated(self):
+        return FieldSerializer.getPrefetchRelated(self) + [
+            self.field + "__" + name
+            for name in getPrefetchRelated(self.other_serializer)]
+
 
 class URLSerializer(FieldSerializer):
     """Serializes model field to an URL. Useful for images.
@@ -171,6 +469,21 @@ class HrefSerializer(FormatStringSerializer):
 
         return '\n'.join([url_value, string_value])
 
+    def getSelectRelated(self):
+        return FormatStringSerializer.getSelectRelated(self) + \
+            getSelectRelated(self.urlSerializer)
+
+    def getPrefetchRelated(self):
+        return FormatStringSerializer.getPrefetchRelated(self) + \
+            getPrefetchRelated(self.urlSerializer)
+
+    def getRequiredFields(self):
+        mine = FormatStringSerializer.getRequiredFields(self)
+        other = getRequiredFields(self.urlSerializer)
+        if mine is None or other is None:
+            return None
+        return mine + other
+
 
 # QuerySet serializers - a different sort of thing, than FieldSerializer
 # they serialize querySets
@@ -178,26 +491,89 @@ class HrefSerializer(FormatStringSerializer):
 class QuerySetSerializer:
     """I serialize sets, row by row, element by element, to a
     specific format.
+
+    Column names and serializers are looked up once, when I am created;
+    serializeRows yields plain tuples of cells, in the order of columns.
+    Rows are serialized in batches of batchSize, column by column.
+
+    With a databasePlan (see datable.web.dbformat), the rows are tuples
+    of values fetched from the database, not models.
     """
 
     output_format = None
+    batchSize = 500
 
-    def __init__(self, columns):
+    def __init__(self, columns, databasePlan=None):
         self.columns = columns
+        self.databasePlan = databasePlan
+        self.names = tuple([column.getName() for column in columns])
+        self.serializers = tuple([column.getSerializer()
+                                  for column in columns])
+        self.plan = tuple([serializer.serialize
+                           for serializer in self.serializers])
+
+    def serializeRow(self, model):
+        output_format = self.output_format
+        return tuple([serialize(model, output_format=output_format)
+                      for serialize in self.plan])
+
+    def serializeBatch(self, models):
+        """Serialize a list of models to a list of tuples."""
+        if not self.serializers:
+            return [() for model in models]
+
+        output_format = self.output_format
+        return list(zip(*[
+            serializeColumn(serializer, models, output_format)
+            for serializer in self.serializers]))
+
+    def serializeRows(self, querySet):
+        if self.databasePlan is not None:
+            # querySet is a QuerySet of tuples from the plan
+            convertRow = self.databasePlan.convertRow
+            for values in querySet:
+                yield convertRow(values)[1]
+            return
+
+        iterator = iter(querySet)
+        while True:
+            models = list(islice(iterator, self.batchSize))
+            if not models:
+                return
+
+            for row in self.serializeBatch(models):
+                yield row
+
+    def nativeBatch(self, models):
+        """serializeBatch, keeping native values (see nativeColumn).
+        """
+        if not self.serializers:
+            return [() for model in models]
+
+        output_format = self.output_format
+        return list(zip(*[
+            nativeColumn(serializer, models, output_format)
+            for serializer in self.serializers]))
+
+    def nativeRows(self, querySet):
+        """serializeRows, keeping native values; rows from a databasePlan
+        are already serialized."""
+        if self.databasePlan is not None:
+            for row in self.serializeRows(querySet):
+                yield row
+            return
+
+        iterator = iter(querySet)
+        while True:
+            models = list(islice(iterator, self.batchSize))
+            if not models:
+                return
+
+            for row in self.nativeBatch(models):
+                yield row
 
     def serializeModel(self, model):
-        row = []
-        for column in self.columns:
-            row.append(
-                (
-                    column.getName(),
-                    column.getSerializer().serialize(
-                        model,
-                        output_format = self.output_format
-                    )
-                )
-            )
-        return OrderedDict(row)
+        return OrderedDict(list(zip(self.names, self.serializeRow(model))))
 
     def serialize(self, querySet):
         for model in querySet:
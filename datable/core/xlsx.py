@@ -0,0 +1,261 @@
+"""A streaming writer of XLSX (Office Open XML) workbooks.
+
+The workbook is written to a zip archive as rows come: static parts
+first, then the sheets' XML, row by row, through zipfile's compressor,
+and the list of sheets last. Strings are written inline (not to a shared
+strings table), so memory does not grow with the number of rows. The
+archive is written to an unseekable buffer, from which data is taken
+with read():
+
+    book = Workbook('Sheet')
+    for row in rows:
+        book.writeRow(row)
+        yield book.read()
+    book.close()
+    yield book.read()
+"""
+
+import math
+import re
+import zipfile
+
+from datetime import date
+from datetime import datetime
+from decimal import Decimal
+
+from xml.sax.saxutils import escape
+
+MAX_ROWS = 1048576
+MAX_TITLE = 31
+
+# Day 0 of Excel's date numbers (as counted after February 1900)
+EPOCH = datetime(1899, 12, 30)
+
+BOLD = 1
+DATE = 2
+DATETIME = 3
+
+# Characters not allowed in XML 1.0
+_invalid = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# Characters not allowed in sheet names
+_invalidTitle = re.compile(r'[\[\]:*?/\\]')
+
+_contentTypes = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+%s
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+_contentTypeSheet = """<Override PartName="/xl/worksheets/sheet%i.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>"""
+
+_rels = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_workbook = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>%s</sheets>
+</workbook>"""
+
+_workbookSheet = """<sheet name="%s" sheetId="%i" r:id="rId%i"/>"""
+
+# Sheets are rId1, rId2, ...; styles come after them
+_workbookRels = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+%s
+<Relationship Id="rId%i" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+_workbookRelsSheet = """<Relationship Id="rId%i" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%i.xml"/>"""
+
+# Style 0 is the default, then BOLD (for headers), DATE and DATETIME
+_styles = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="2"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/><numFmt numFmtId="165" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="4"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/><xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/><xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>
+</styleSheet>"""
+
+_sheetStart = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>"""
+
+_sheetEnd = """</sheetData></worksheet>"""
+
+
+class TooManyRows(Exception):
+    pass
+
+
+class Output:
+    """An unseekable file-like object, collecting data written by zipfile
+    until it is read."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def read(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def columnName(number):
+    """Name of a column, counted from 0: A, B, ..., Z, AA, ..."""
+    name = ''
+    number += 1
+    while number:
+        number, rest = divmod(number - 1, 26)
+        name = chr(ord('A') + rest) + name
+    return name
+
+
+def cleanTitle(title):
+    return _invalidTitle.sub('_', str(title))[:MAX_TITLE] or 'Sheet'
+
+
+def dateNumber(value):
+    """Excel's number of a date or a datetime (in its own time zone)."""
+    if isinstance(value, datetime):
+        value = value.replace(tzinfo=None)
+    else:
+        value = datetime(value.year, value.month, value.day)
+    delta = value - EPOCH
+    return delta.days + delta.seconds / 86400.0
+
+
+def formatCell(ref, value, style):
+    """XML of a cell, or an empty string for None. Dates are written as
+    numbers, in the DATE or DATETIME style."""
+    if value is None:
+        return ''
+
+    if isinstance(value, date):
+        if isinstance(value, datetime):
+            style = DATETIME
+        else:
+            style = DATE
+        value = dateNumber(value)
+
+    attrs = 'r="%s"' % ref
+    if style:
+        attrs += ' s="%i"' % style
+
+    if isinstance(value, bool):
+        return '<c %s t="b"><v>%i</v></c>' % (attrs, value)
+
+    if isinstance(value, int) or \
+       isinstance(value, (float, Decimal)) and math.isfinite(value):
+        return '<c %s><v>%s</v></c>' % (attrs, value)
+
+    value = _invalid.sub('', str(value))
+    return '<c %s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+        attrs, escape(value))
+
+
+class Workbook:
+    """I write a workbook, sheet by sheet and row by row. Sheets are
+    limited to MAX_ROWS rows; start another one with addSheet.
+    """
+
+    def __init__(self, title='Sheet'):
+        self.output = Output()
+        self.archive = zipfile.ZipFile(
+            self.output, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.columns = []
+        self.titles = []
+        self.sheet = None
+
+        for name, data in [
+                ('_rels/.rels', _rels),
+                ('xl/styles.xml', _styles)]:
+            self.archive.writestr(name, data.encode('utf-8'))
+
+        self.addSheet(title)
+
+    def addSheet(self, title):
+        """Finish the current sheet; rows are written to a new one from
+        now on. Titles should be unique."""
+        self.closeSheet()
+
+        self.titles.append(cleanTitle(title))
+        self.rows = 0
+        self.sheet = self.archive.open(
+            'xl/worksheets/sheet%i.xml' % len(self.titles), 'w',
+            force_zip64=True)
+        self.sheet.write(_sheetStart.encode('utf-8'))
+
+    def closeSheet(self):
+        if self.sheet is not None:
+            self.sheet.write(_sheetEnd.encode('utf-8'))
+            self.sheet.close()
+            self.sheet = None
+
+    def getColumnName(self, number):
+        while len(self.columns) <= number:
+            self.columns.append(columnName(len(self.columns)))
+        return self.columns[number]
+
+    def rowsLeft(self):
+        """Number of rows, which can still be written to the sheet."""
+        return MAX_ROWS - self.rows
+
+    def writeRow(self, values, bold=False):
+        if self.rows >= MAX_ROWS:
+            raise TooManyRows(
+                "An XLSX sheet can not have more than %i rows" % MAX_ROWS)
+
+        self.rows += 1
+        style = 0
+        if bold:
+            style = BOLD
+
+        cells = [formatCell('%s%i' % (self.getColumnName(no), self.rows),
+                            value, style)
+                 for no, value in enumerate(values)]
+
+        self.sheet.write(
+            ('<row r="%i">%s</row>' % (self.rows, ''.join(cells))).encode(
+                'utf-8'))
+
+    def close(self):
+        self.closeSheet()
+
+        numbers = range(1, len(self.titles) + 1)
+        for name, data in [
+                ('[Content_Types].xml', _contentTypes % ''.join(
+                    [_contentTypeSheet % no for no in numbers])),
+                ('xl/workbook.xml', _workbook % ''.join(
+                    [_workbookSheet % (
+                        escape(title, {'"': '&quot;'}), no, no)
+                     for no, title in zip(numbers, self.titles)])),
+                ('xl/_rels/workbook.xml.rels', _workbookRels % (
+                    ''.join([_workbookRelsSheet % (no, no)
+                             for no in numbers]),
+                    len(self.titles) + 1))]:
+            self.archive.writestr(name, data.encode('utf-8'))
+
+        self.archive.close()
+
+    def read(self):
+        """Data written since the last call."""
+        return self.output.read()
@@ -52,6 +52,10 @@ class BaseDatableNode(template.Node):
         opts['name'] = self.table_name
         opts['objectpath'] = table.objectpath
         opts['widgets'] = table.getStorage().getWidgets()
+        opts['keyset'] = table.getStorage().keysetPagination
+        opts['delta'] = table.getStorage().useDelta()
+        opts['countCap'] = table.getStorage().countCap
+        opts['jobs'] = table.backgroundExports
         opts['fields'] = []
 
         ds = table.getStorage().defaultSort
@@ -169,6 +173,12 @@ class DatableCSVButtonNode(DatableXLSButtonNode):
     templateName = templatePath("csv_button")
 
 
+class DatableXLSXButtonNode(DatableXLSButtonNode):
+    """See DatableXLSButtonNode
+    """
+    templateName = templatePath("xlsx_button")
+
+
 class DatableClearAllFiltersButtonNode(DatableXLSButtonNode):
     """Clear all filters button
     """
@@ -267,6 +277,7 @@ for tagname, node in [
     ('datable_menu_button', DatableMenuButtonNode),
     ('datable_clear_all_filters_button', DatableClearAllFiltersButtonNode),
     ('datable_xls_button', DatableXLSButtonNode),
+    ('datable_xlsx_button', DatableXLSXButtonNode),
     ('datable_csv_button', DatableCSVButtonNode)]:
     register.tag(tagname, lambda parser, token, node=node:
         datable_helper(parser, token, node))
@@ -8,6 +8,7 @@ import pytz
 
 from datable import core
 from datable.core import formats
+from datable.core import xlsx
 
 class TestSimpleFilter(TestCase):
     def test_simple(self):
@@ -156,6 +157,13 @@ class TestFieldSerializer(TestCase):
         s = core.serializers.FormatStringSerializer("%(bar)s %(baz)s")
         self.assertEquals(s.serialize(Foo()), "1 quux")
 
+    def test_formatSerializer_getRequiredFields(self):
+        s = core.serializers.FormatStringSerializer("%(bar)s %%(x)s %(baz)i")
+        self.assertEquals(s.getRequiredFields(), ['bar', 'baz'])
+
+        s = core.serializers.UnicodeSerializer()
+        self.assertEquals(s.getRequiredFields(), None)
+
 
 class TestSerializerMixin:
     firstValue = None
@@ -205,6 +213,104 @@ class TestTimedeltaSerializer(TestSerializerMixin, TestCase):
     shouldBe = [_('%i.00 sec.') % 5, _('[no data]')]
 
 
+class TestSerializeBatch(TestCase):
+    def test_dateSerializer(self):
+        d = date(2011, 11, 11)
+        self.assertEquals(
+            core.DateSerializer('foo').serialize_batch([d, None, d]),
+            ['2011-11-11', _('[no data]'), '2011-11-11'])
+
+    def test_dateTimeSerializer(self):
+        d = datetime(2011, 11, 11, 1, 2, 3)
+        self.assertEquals(
+            core.DateTimeSerializer('foo').serialize_batch([d, None]),
+            ['2011-11-11 01:02:03', _('[no data]')])
+
+    def test_dateTimeSerializer_date(self):
+        s = core.DateTimeSerializer('foo')
+        d = date(2011, 11, 11)
+        self.assertEquals(s.serialize_batch([d]), [s.serialize_value(d)])
+        self.assertEquals(s.native_batch([d]), [d])
+
+    def test_dateSerializer_aware(self):
+        from django.test.utils import override_settings
+        s = core.DateSerializer('foo')
+        d = datetime(2011, 11, 11, 23, 30, tzinfo=pytz.utc)
+        with override_settings(USE_TZ=True, TIME_ZONE='Europe/Warsaw'):
+            self.assertEquals(s.native_batch([d, None]),
+                              [date(2011, 11, 12), _('[no data]')])
+            self.assertEquals(s.serialize_batch([d]), ['2011-11-12'])
+            self.assertEquals(s.serialize_value(d), '2011-11-12')
+
+    def test_booleanSerializer(self):
+        self.assertEquals(
+            core.BooleanSerializer('foo').serialize_batch([True, False, None]),
+            [_('yes'), '-', _('[no data]')])
+
+    def test_serialize_column_custom_serialize_value(self):
+        class Custom(core.DateSerializer):
+            def serialize_value(self, value, output_format=None):
+                return 'custom'
+
+        class Foo:
+            foo = date(2011, 11, 11)
+
+        self.assertEquals(
+            Custom('foo').serialize_column([Foo()]), ['custom'])
+
+    def test_foreignKeySerializer(self):
+        class Other:
+            name = 'bar'
+
+        class Foo:
+            foo = Other()
+
+        u = core.ForeignKeySerializer('foo', core.StringSerializer('name'))
+        self.assertEquals(u.serialize_column([Foo(), Foo()]), ['bar', 'bar'])
+
+
+class TestNativeColumn(TestCase):
+    def test_native(self):
+        class Foo:
+            number = 5
+            when = datetime(2011, 11, 11, 1, 2, 3)
+            flag = False
+            nothing = None
+
+        self.assertEquals(
+            [core.nativeColumn(serializer, [Foo()]) for serializer in [
+                core.StringSerializer('number'),
+                core.DateTimeSerializer('when'),
+                core.BooleanSerializer('flag'),
+                core.StringSerializer('nothing')]],
+            [[5], [Foo.when], [False], [_('[no data]')]])
+
+    def test_notNative(self):
+        class Custom(core.DateSerializer):
+            def serialize_value(self, value, output_format=None):
+                return 'custom'
+
+        class Foo:
+            foo = date(2011, 11, 11)
+            length = timedelta(seconds=5)
+
+        self.assertEquals(
+            core.nativeColumn(Custom('foo'), [Foo()]), ['custom'])
+        self.assertEquals(
+            core.nativeColumn(core.TimedeltaSerializer('length'), [Foo()]),
+            [_('%i.00 sec.') % 5])
+
+    def test_foreignKeySerializer(self):
+        class Other:
+            count = 3
+
+        class Foo:
+            foo = Other()
+
+        u = core.ForeignKeySerializer('foo', core.StringSerializer('count'))
+        self.assertEquals(core.nativeColumn(u, [Foo()]), [3])
+
+
 class TestForeignKeySerializer(TestCase):
     def test_foreignKeySerializer(self):
         u = core.ForeignKeySerializer(
@@ -231,6 +337,26 @@ class TestForeignKeySerializer(TestCase):
 
         self.assertEquals('foo__bar__baz', u.getFieldName())
 
+    def test_getSelectRelated(self):
+        u = core.ForeignKeySerializer(
+            'foo',
+            core.ForeignKeySerializer(
+                'bar',
+                core.StringSerializer('baz')
+                )
+            )
+
+        self.assertEquals(['foo', 'foo__bar'], u.getSelectRelated())
+        self.assertEquals([], u.getPrefetchRelated())
+
+    def test_getPrefetchRelated(self):
+        class AuthorsSerializer(core.UnicodeSerializer):
+            prefetchRelated = ('authors', )
+
+        u = core.ForeignKeySerializer('foo', AuthorsSerializer())
+        self.assertEquals(['foo__authors'], u.getPrefetchRelated())
+        self.assertEquals([], core.getPrefetchRelated(object()))
+
 
 class TestURLSerializer(TestCase):
     def test_urlSerializer(self):
@@ -274,12 +400,14 @@ class TestHrefSerializer(TestCase):
 
 
 def fakeQuerySet():
-    with Mock() as mock:
-         for a in [1,2,3]:
-             mock.__getattr__('foo') >> 123
-             mock.__getattr__('pk') >> a
+    result = []
+    for a in [1,2,3]:
+        with Mock() as mock:
+            mock.__getattr__('foo') >> 123
+            mock.__getattr__('pk') >> a
+        result.append(mock)
 
-    return [mock, mock, mock]
+    return result
 
 
 def fakeQuerySetNoIDs():
@@ -306,8 +434,46 @@ class TestQuerySetSerializer(TestCase):
         l = list(f.serialize(fakeQuerySetNoIDs()[:1]))
         self.assertEquals(l, [{'foo':'123'}])
 
+    def test_serializeRows(self):
+        f = core.QuerySetSerializer([
+            FakeColumn()
+        ])
+
+        self.assertEquals(f.names, ('foo', ))
+        l = list(f.serializeRows(fakeQuerySetNoIDs()[:2]))
+        self.assertEquals(l, [('123', ), ('123', )])
+
+
+class TestXLSX(TestCase):
+    def test_columnName(self):
+        self.assertEquals(
+            [xlsx.columnName(no) for no in (0, 25, 26, 701, 702)],
+            ['A', 'Z', 'AA', 'ZZ', 'AAA'])
+
+    def test_formatCell(self):
+        self.assertEquals(xlsx.formatCell('A1', None, 0), '')
+        self.assertEquals(xlsx.formatCell('A1', 5, 0), '<c r="A1"><v>5</v></c>')
+        self.assertEquals(
+            xlsx.formatCell('B2', 'a<b\x01', 1),
+            '<c r="B2" s="1" t="inlineStr">'
+            '<is><t xml:space="preserve">a&lt;b</t></is></c>')
+
+    def test_formatCell_dates(self):
+        self.assertEquals(
+            xlsx.formatCell('A1', date(2000, 1, 1), 0),
+            '<c r="A1" s="2"><v>36526.0</v></c>')
+        self.assertEquals(
+            xlsx.formatCell('A1', datetime(2000, 1, 1, 12), 0),
+            '<c r="A1" s="3"><v>36526.5</v></c>')
+
 
 class TestFormats(TestCase):
     def test_getExtension(self):
         self.assertEquals(
             'xls', core.formats.getExtension(core.formats.XLS))
+        self.assertEquals(
+            'xlsx', core.formats.getExtension(core.formats.XLSX))
+        self.assertEquals(
+            core.formats.XLSX, core.formats.getFormat('xlsx'))
+        self.assertRaises(
+            core.formats.UnknownFormat, core.formats.getFormat, 'exe')
@@ -1,24 +1,58 @@
 from django.http import Http404
+from django.core.exceptions import ImproperlyConfigured
 
 from datable.web import columns
 from datable.web import widgets
 from datable.core import converters
+from datable.core import xlsx
 from datable.web import storage
 from datable.core.serializers import StringSerializer
 from datable.core.serializers import PrimaryKeySerializer
+from datable.core.serializers import ForeignKeySerializer
+from datable.core.serializers import UnicodeSerializer
+from datable.core.serializers import BooleanSerializer
+from datable.core.serializers import DateTimeSerializer
+from datable.core.serializers import FormatStringSerializer
 from datable.web import serializers
 from datable.web import table
 from datable.web.util import getFullPath
-
+from datable.web.util import ChunkedIterator
+from datable.web.util import getRelatedModels
+from datable.web.util import etagMatches
+from datable.web.util import parseRange
+from datable.web import pagination
+from datable.web import parallel
+from datable.web import aio
+from datable.web import dbformat
+from datable.web import registry
+from datable.web import push
+from datable.web import cache
+from datable.web import snapshots
+from datable.web import jobs
+from datable.web import exportcache
+from datable.web import util
+from datable.web.state import FilterState
+
+import asyncio
 import json
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
 
 from ludibrio import Mock, Stub
 from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.auth.models import Group
+from django.contrib.auth.models import Permission
 from datable.tests.test_core import fakeQuerySet
 from datable.tests.test_core import FakeColumn
 from datable.tests.test_core import fakeQuerySetNoIDs
 from datetime import datetime
+from datetime import time
 from datable.core import formats
+from io import BytesIO
 from io import StringIO
 
 # # # ## # # ## # # ## # # ## # # ## # # ## # # ## # # ## # # ## # # #
@@ -129,6 +163,19 @@ class TestXLSQuerySetSerializer(TestCase):
                                'tytul', ['nag', 'lowek'],
                                [['exp'], ['exp']])
 
+    def test_xlsQuerySetSerializer_sheets(self):
+        x = serializers.XLSQuerySetSerializer([
+            FakeColumn()
+        ])
+        x.maxRows = 3
+
+        xls_file = x.serialize(fakeQuerySetNoIDs(),
+                               'tytul', ['nag'], [])
+
+        self.assertEquals(x.getSheetTitle('tytul', 2), 'tytul (2)')
+        self.assertEquals(len(x.getSheetTitle('x' * 40, 12)), 31)
+        self.assertTrue(xls_file.read().startswith(b'\xd0\xcf\x11\xe0'))
+
 
 class TestCSVQuerySetSerializer(TestCase):
 
@@ -142,6 +189,66 @@ class TestCSVQuerySetSerializer(TestCase):
                                'tytul', ['nag', 'lowek'],
                                [['exp'], ['exp']])
 
+    def test_csvQuerySetSerializer_stream(self):
+
+        x = serializers.CSVQuerySetSerializer([
+            FakeColumn()
+        ])
+        x.chunkRows = 2
+
+        chunks = list(x.stream(fakeQuerySetNoIDs(),
+                               'tytul', ['nag', 'lowek'],
+                               [['exp'], ['exp']]))
+
+        self.assertEquals(len(chunks), 3)
+        self.assertEquals(chunks[1], b'123\r\n123\r\n')
+        self.assertEquals(chunks[2], b'123\r\n')
+
+class TestXLSXQuerySetSerializer(TestCase):
+
+    def test_xlsxQuerySetSerializer_stream(self):
+
+        x = serializers.XLSXQuerySetSerializer([
+            FakeColumn()
+        ])
+
+        data = b''.join(x.stream(fakeQuerySetNoIDs(),
+                                 'tytul', ['nag', 'lowek'],
+                                 [['exp'], ['exp']]))
+
+        archive = zipfile.ZipFile(BytesIO(data))
+        sheet = archive.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertTrue('<t xml:space="preserve">lowek</t>' in sheet)
+        self.assertEquals(sheet.count('<row '), 7)
+        self.assertTrue('<v>123</v>' in sheet)
+
+    def test_xlsxQuerySetSerializer_stream_maxRows(self):
+        x = serializers.XLSXQuerySetSerializer([
+            FakeColumn()
+        ])
+
+        maxRows = xlsx.MAX_ROWS
+        xlsx.MAX_ROWS = 6
+        try:
+            data = b''.join(x.stream(fakeQuerySetNoIDs(),
+                                     'tytul', ['nag', 'lowek'],
+                                     [['exp'], ['exp']]))
+        finally:
+            xlsx.MAX_ROWS = maxRows
+
+        # The last row continues on another sheet, after the header
+        archive = zipfile.ZipFile(BytesIO(data))
+        sheets = [archive.read('xl/worksheets/sheet%i.xml' % no).decode(
+            'utf-8') for no in (1, 2)]
+        self.assertEquals([sheet.count('<row ') for sheet in sheets], [6, 2])
+        self.assertTrue('lowek' in sheets[1])
+        self.assertTrue('<v>123</v>' in sheets[1])
+
+        workbook = archive.read('xl/workbook.xml').decode('utf-8')
+        self.assertTrue('name="tytul (2)" sheetId="2" r:id="rId2"' in workbook)
+        self.assertTrue('worksheets/sheet2.xml' in archive.read(
+            'xl/_rels/workbook.xml.rels').decode('utf-8'))
+
 
 ## # #  # # # #  # # #
 
@@ -166,6 +273,376 @@ class TestWebUtil(TestCase):
             'http://test.host/lol',
             getFullPath(fr))
 
+    def test_etagMatches(self):
+        self.assertTrue(etagMatches('"abc"', 'abc'))
+        self.assertTrue(etagMatches('"x", W/"abc"', 'abc'))
+        self.assertTrue(etagMatches('*', 'abc'))
+        self.assertFalse(etagMatches('"x"', 'abc'))
+        self.assertFalse(etagMatches(None, 'abc'))
+
+    def test_parseRange(self):
+        self.assertEquals(parseRange('bytes=0-499', 1000), (0, 499))
+        self.assertEquals(parseRange('bytes=500-', 1000), (500, 999))
+        self.assertEquals(parseRange('bytes=-100', 1000), (900, 999))
+        self.assertEquals(parseRange('bytes=1000-', 1000), (1000, 999))
+        self.assertEquals(parseRange('bytes=0-1,5-6', 1000), None)
+        self.assertEquals(parseRange(None, 1000), None)
+
+    def test_getRelatedModels(self):
+        self.assertEquals(getRelatedModels(User, 'groups'), [Group])
+        self.assertEquals(
+            getRelatedModels(User, 'groups__permissions__name'),
+            [Group, Permission])
+        self.assertEquals(getRelatedModels(User, 'username'), [])
+
+class TestChunkedIterator(TestCase):
+    def test_chunkedIterator(self):
+        with Mock() as querySet:
+            querySet.iterator(chunk_size=2) >> iter([1, 2, 3])
+
+        rows = ChunkedIterator(querySet, 2)
+        self.assertEquals(list(rows), [1, 2, 3])
+        self.assertEquals(rows.rows, 3)
+        self.assertEquals(rows.chunks, 2)
+        querySet.validate()
+
+    def test_chunkedIterator_noChunkSize(self):
+
+        class OldQuerySet:
+            def iterator(self):
+                return iter([1, 2])
+
+        rows = ChunkedIterator(OldQuerySet(), 5)
+        self.assertEquals(list(rows), [1, 2])
+        self.assertEquals(rows.chunks, 1)
+
+    def test_prefetchInChunks(self):
+        prefetched = []
+
+        def prefetch(models, *lookups):
+            prefetched.append((list(models), lookups))
+
+        old = util.prefetch_related_objects
+        util.prefetch_related_objects = prefetch
+        try:
+            models = list(util.prefetchInChunks(iter([1, 2, 3]), ['tags'], 2))
+        finally:
+            util.prefetch_related_objects = old
+
+        self.assertEquals(models, [1, 2, 3])
+        self.assertEquals(prefetched, [([1, 2], ('tags',)),
+                                       ([3], ('tags',))])
+
+    def test_getExportDirectory(self):
+        base = tempfile.mkdtemp()
+        try:
+            with self.settings(DATABLE_EXPORT_DIR=None):
+                self.assertRaises(ImproperlyConfigured,
+                                  util.getExportDirectory, 'jobs')
+
+            with self.settings(DATABLE_EXPORT_DIR=base):
+                path = util.getExportDirectory('jobs')
+            self.assertEquals(path, os.path.join(base, 'jobs'))
+            self.assertEquals(os.stat(path).st_mode & 0o777, 0o700)
+
+            self.assertEquals(util.getExportDirectory('jobs', base), base)
+        finally:
+            shutil.rmtree(base)
+
+class TestPagination(TestCase):
+    def test_cursor(self):
+        c = pagination.Cursor(
+            25, [datetime(2011, 1, 1), 7], ['-foo', '-pk'], 'k')
+        d = pagination.Cursor.decode(c.encode())
+        self.assertEquals(d.values, [datetime(2011, 1, 1), 7])
+        self.assertEquals(d.matches(25, ['-foo', '-pk'], 'k'), True)
+        self.assertEquals(d.matches(25, ['foo', 'pk'], 'k'), False)
+        self.assertEquals(d.matches(50, ['-foo', '-pk'], 'k'), False)
+        self.assertEquals(d.matches(25, ['-foo', '-pk'], 'other'), False)
+
+    def test_cursor_timeAndUUID(self):
+        pk = uuid.UUID('12345678123456781234567812345678')
+        c = pagination.Cursor(5, [time(13, 30, 15), pk], ['foo', 'pk'], 'k')
+        d = pagination.Cursor.decode(c.encode())
+        self.assertEquals(d.values, [time(13, 30, 15), pk])
+
+    def test_cursor_invalid(self):
+        self.assertEquals(pagination.Cursor.decode(None), None)
+        self.assertEquals(pagination.Cursor.decode('garbage!'), None)
+
+    def test_orderForSeek(self):
+        with Mock() as querySet:
+            querySet.order_by('-foo', '-pk')
+            querySet.order_by('pk')
+
+        pagination.orderForSeek(querySet, ['-foo', '-pk'])
+        pagination.orderForSeek(querySet, ['pk'])
+        querySet.validate()
+
+    def test_getOrdering(self):
+        self.assertEquals(
+            pagination.getOrdering(Permission.objects.all()),
+            list(Permission._meta.ordering))
+        self.assertEquals(
+            pagination.getOrdering(Permission.objects.order_by('-name')),
+            ['-name'])
+        self.assertEquals(
+            pagination.getOrdering(Permission.objects.order_by()), [])
+
+    def test_fetchByPrimaryKeys(self):
+        class Foo:
+            def __init__(self, pk):
+                self.pk = pk
+
+        with Mock() as querySet:
+            querySet.filter(pk__in=[3, 1, 2]) >> [Foo(1), Foo(3)]
+
+        res = pagination.fetchByPrimaryKeys(querySet, [3, 1, 2])
+        self.assertEquals([x.pk for x in res], [3, 1])
+        self.assertEquals(pagination.fetchByPrimaryKeys(querySet, []), [])
+
+    def test_getAttribute(self):
+        class Foo:
+            bar = None
+        foo = Foo()
+        foo.baz = Foo()
+        foo.baz.bar = 5
+
+        self.assertEquals(pagination.getAttribute(foo, 'baz__bar'), 5)
+        self.assertEquals(pagination.getAttribute(foo, 'bar__quux'), None)
+
+class TestParallel(TestCase):
+    def test_callWith(self):
+        future = parallel.submit(lambda x, y: x + y, 1, y=2)
+        self.assertEquals(
+            parallel.callWith(future, lambda x: x * 2, 5), (3, 10))
+
+    def test_callWith_errors(self):
+        def fail():
+            raise ValueError("fail")
+
+        future = parallel.submit(fail)
+        self.assertRaises(ValueError, parallel.callWith, future, int, 5)
+
+        future = parallel.submit(int, 5)
+        self.assertRaises(ValueError, parallel.callWith, future, fail)
+
+class TestAio(TestCase):
+    def test_alist(self):
+        self.assertEquals(asyncio.run(aio.alist(iter([1, 2]))), [1, 2])
+
+    def test_aiterate(self):
+        async def collect():
+            return [x async for x in aio.aiterate([b'a', b'b'])]
+
+        self.assertEquals(asyncio.run(collect()), [b'a', b'b'])
+
+class TestPush(TestCase):
+    def test_localBroker(self):
+        broker = push.LocalBroker()
+        self.assertEquals(broker.current('foo'), 0)
+        self.assertEquals(broker.wait('foo', 0, 0.01), 0)
+
+        broker.publish('foo')
+        self.assertEquals(broker.wait('foo', 0, 0.01), 1)
+        self.assertEquals(broker.current('bar'), 0)
+
+    def test_invalidate_publishes(self):
+        broker = push.LocalBroker()
+        old = push.getBroker()
+        push.setBroker(broker)
+        try:
+            cache.invalidate('push_test')
+        finally:
+            push.setBroker(old)
+
+        self.assertEquals(broker.current('push_test'), 1)
+
+    def test_formatEvent(self):
+        self.assertEquals(
+            push.formatEvent('changed', {'version': 'abc'}),
+            b'event: changed\ndata: {"version": "abc"}\n\n')
+
+class TestSnapshots(TestCase):
+    def test_makeKeys(self):
+        self.assertEquals(list(snapshots.makeKeys(iter([3, 1]))), [3, 1])
+        self.assertEquals(snapshots.makeKeys(['a']), None)
+
+    def test_cacheSnapshots(self):
+        store = snapshots.CacheSnapshots(cache.defaultCache, 60)
+        store.save('datable:test:snapshot', snapshots.makeKeys([5, 3, 9]))
+
+        self.assertEquals(
+            store.load('datable:test:snapshot', 1, 1), ([3], 3))
+        self.assertEquals(
+            store.load('datable:test:snapshot', 0, None), ([5, 3, 9], 3))
+        self.assertEquals(store.load('datable:test:none', 0, 1), None)
+
+    def test_cacheSnapshots_maxBytes(self):
+        store = snapshots.CacheSnapshots(cache.defaultCache, 60, maxBytes=16)
+        self.assertEquals(store.getMaxRows(), 2)
+        self.assertEquals(
+            store.save('datable:test:big', snapshots.makeKeys([5, 3, 9])),
+            False)
+        self.assertEquals(
+            store.load('datable:test:big', 0, 1), snapshots.TOO_BIG)
+
+    def test_fileSnapshots(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = snapshots.FileSnapshots(directory, 60)
+            store.save('foo', snapshots.makeKeys([5, 3, 9]))
+
+            self.assertEquals(store.load('foo', 1, 5), ([3, 9], 3))
+            self.assertEquals(store.load('foo', 10, 5), ([], 3))
+            self.assertEquals(store.load('bar', 0, 1), None)
+
+            store.timeout = -1
+            self.assertEquals(store.load('foo', 0, 1), None)
+        finally:
+            shutil.rmtree(directory)
+
+class TestJobs(TestCase):
+    def setUp(self):
+        self.directory = jobs.directory
+        jobs.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(jobs.directory)
+        jobs.directory = self.directory
+
+    def test_isValidId(self):
+        self.assertTrue(jobs.isValidId('0123456789abcdef' * 2))
+        self.assertFalse(jobs.isValidId('../../etc/passwd'))
+        self.assertFalse(jobs.isValidId(None))
+        self.assertEquals(jobs.readState('../foo'), None)
+
+    def test_run(self):
+        class FakeStorage:
+            def getCount(self, querySet, state):
+                return 2, False
+
+            def filterQuerySet(self, state):
+                return None
+
+            def exportToFile(self, state, output_format, f, progress):
+                progress(2)
+                f.write(b'a\r\nb\r\n')
+                return 2
+
+        class FakeTable:
+            name = 'foo'
+            getStorage = lambda self: FakeStorage()
+
+        state = dict(id='0123456789abcdef' * 2, table='foo', format='csv')
+        jobs.run(state, FakeTable(), None, formats.CSV, None)
+
+        state = jobs.readState(state['id'])
+        self.assertEquals(state['status'], jobs.DONE)
+        self.assertEquals((state['rows'], state['total']), (2, 2))
+
+        path, output_format = jobs.getFile(state['id'])
+        self.assertEquals(output_format, formats.CSV)
+        with open(path, 'rb') as f:
+            self.assertEquals(f.read(), b'a\r\nb\r\n')
+
+class TestExportCache(TestCase):
+    def setUp(self):
+        self.directory = exportcache.directory
+        exportcache.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(exportcache.directory)
+        exportcache.directory = self.directory
+
+    def test_store(self):
+        self.assertEquals(exportcache.lookup('foo', formats.CSV), None)
+
+        path = exportcache.store('foo', formats.CSV, lambda f: f.write(b'a'))
+        self.assertEquals(exportcache.lookup('foo', formats.CSV), path)
+
+    def test_evict(self):
+        maxSize = exportcache.maxSize
+        exportcache.maxSize = 15
+        try:
+            old = exportcache.store(
+                'old', formats.CSV, lambda f: f.write(b'a' * 10))
+            os.utime(old, (0, 0))
+            exportcache.store('new', formats.CSV, lambda f: f.write(b'a' * 10))
+        finally:
+            exportcache.maxSize = maxSize
+
+        self.assertEquals(exportcache.lookup('old', formats.CSV), None)
+        self.assertNotEquals(exportcache.lookup('new', formats.CSV), None)
+
+    def test_getKey(self):
+        keys = [
+            exportcache.getKey(
+                storage.Storage(
+                    User.objects.filter(username=name),
+                    columns=[columns.StringColumn('username')],
+                    cacheName='test_getKey'),
+                FilterState(), formats.CSV)
+            for name in ('a', 'b')]
+        self.assertNotEquals(keys[0], keys[1])
+
+    def test_maxAge(self):
+        stale = exportcache.store('stale', formats.CSV, lambda f: f.write(b'a'))
+        os.utime(stale, (0, 0))
+        self.assertEquals(exportcache.lookup('stale', formats.CSV), None)
+
+        exportcache.store('new', formats.CSV, lambda f: f.write(b'a'))
+        self.assertFalse(os.path.exists(stale))
+
+class TestDatabaseFormatting(TestCase):
+    def setUp(self):
+        User.objects.create(
+            username='joe', first_name='Joe', last_name='Smith',
+            date_joined=datetime(2010, 1, 2, 3, 4, 5))
+        self.querySet = User.objects.order_by('pk')
+
+    def test_compilePlan(self):
+        serializers = [
+            StringSerializer('username'),
+            BooleanSerializer('is_staff'),
+            DateTimeSerializer('date_joined'),
+            FormatStringSerializer('%(first_name)s %(last_name)s'),
+            StringSerializer('last_login')]
+
+        plan = dbformat.compilePlan(serializers, self.querySet)
+        for values, model in zip(plan.valuesList(self.querySet),
+                                 self.querySet):
+            (pk, ), row = plan.convertRow(values)
+            self.assertEquals(pk, model.pk)
+            self.assertEquals(row, tuple([
+                serializer.serialize(model)
+                for serializer in serializers]))
+
+    def test_foreignKey(self):
+        # A column naming a ForeignKey shows the related model, not its id
+        items = []
+        for databaseFormatting in [False, True]:
+            s = storage.Storage(
+                Permission.objects.all(),
+                columns=[
+                    columns.StringColumn('content_type'),
+                    columns.StringColumn('label', serializer=
+                        FormatStringSerializer('%(content_type)s %(name)s'))],
+                databaseFormatting=databaseFormatting)
+            items.append(s.serializeToJSON(
+                {'start': '0', 'count': '3'})['items'])
+
+        self.assertEquals(items[0], items[1])
+        permission = Permission.objects.get(pk=items[0][0]['pk'])
+        self.assertEquals(items[0][0]['content_type'],
+                          str(permission.content_type))
+
+    def test_compilePlan_unknown(self):
+        self.assertEquals(dbformat.compilePlan(
+            [UnicodeSerializer()], self.querySet), None)
+        self.assertEquals(dbformat.compilePlan(
+            [StringSerializer('no_such_field')], self.querySet), None)
+
 ## # # # # # (@*#(* $(#* #)($ )#($ )#( )$( )( #)($ )#( )(# $
 
 class TestStorage(TestCase):
@@ -176,7 +653,8 @@ class TestStorage(TestCase):
         self.s = storage.Storage(
             None,
             widgets=[self.w],
-            columns=[self.c]
+            columns=[self.c],
+            projectFields=False
             )
 
         self.valueDict = {'table': None, 'foo': '5', 'sort': '-foo'}
@@ -193,6 +671,7 @@ class TestStorage(TestCase):
 
     def test_filterAndSort(self):
         with Mock() as querySet:
+            querySet.all()
             querySet.filter(foo__contains='5')
             querySet.order_by('-foo')
 
@@ -202,6 +681,7 @@ class TestStorage(TestCase):
 
     def test_defaultSort(self):
         with Mock() as querySet:
+            querySet.all()
             querySet.filter(foo__contains='5')
             querySet.order_by('-foo')
 
@@ -211,6 +691,51 @@ class TestStorage(TestCase):
         querySet.validate()
 
 
+    def test_getRelatedPlan(self):
+        self.s.columns.append(columns.Column(
+            'bar', serializer=ForeignKeySerializer(
+                'bar', ForeignKeySerializer('baz', StringSerializer('quux')))))
+        self.assertEquals(self.s.getRelatedPlan(), (['bar__baz'], []))
+
+    def test_planQuerySet(self):
+        self.s.columns.append(columns.Column(
+            'bar', serializer=ForeignKeySerializer(
+                'bar', StringSerializer('quux'))))
+
+        with Mock() as querySet:
+            querySet.select_related('bar') >> querySet
+
+        self.s.planQuerySet(querySet)
+        querySet.validate()
+
+    def test_getRequiredFields(self):
+        self.assertEquals(self.s.getRequiredFields(), ['foo'])
+
+        self.s.columns.append(columns.Column(
+            'bar', serializer=ForeignKeySerializer(
+                'bar', StringSerializer('quux'))))
+        self.assertEquals(
+            self.s.getRequiredFields((self.c, False)),
+            ['foo', 'bar', 'bar__quux'])
+
+        self.s.columns.append(columns.Column(
+            'baz', serializer=UnicodeSerializer()))
+        self.assertEquals(self.s.getRequiredFields(), None)
+
+    def test_projectQuerySet(self):
+        s = storage.Storage(
+            User.objects.all(),
+            columns=[columns.StringColumn('username')])
+
+        querySet = s.filterAndSort({}, None)
+        self.assertEquals(
+            querySet.query.deferred_loading, (set(['username']), False))
+
+        s.columns.append(columns.StringColumn('no_such_field'))
+        querySet = s.filterAndSort({}, None)
+        self.assertEquals(
+            querySet.query.deferred_loading, (set(), True))
+
     def test_getWidgets(self):
         self.assertEquals(
             self.s.getWidgets(),
@@ -247,6 +772,30 @@ class TestStorage(TestCase):
         res = list(self.s.describeExportData(self.valueDict))
         self.assertEquals(res[-1][0], 'Foo')
 
+    def test_getFilterState(self):
+        state = self.s.getFilterState(self.valueDict, (self.c, True))
+        self.assertIsInstance(state, FilterState)
+        self.assertEquals(state.values, (('foo', '5'), ))
+        self.assertEquals(state['foo'], '5')
+        self.assertEquals(state.sort, (self.c, True))
+        self.assertEquals((state.start, state.count), (0, None))
+        self.assertRaises(AttributeError, setattr, state, 'sort', None)
+
+        self.assertIs(self.s.getFilterState(state), state)
+
+        other = self.s.getFilterState(
+            dict(self.valueDict, table='json'), (self.c, True))
+        self.assertEquals(state, other)
+        self.assertEquals(hash(state), hash(other))
+
+        other = self.s.getFilterState(
+            dict(self.valueDict, start='25'), (self.c, True))
+        self.assertNotEquals(state, other)
+        self.assertEquals(state.filterKey, other.filterKey)
+
+        other = self.s.getFilterState(self.valueDict, (self.c, False))
+        self.assertNotEquals(state.key, other.key)
+
     def test_serializeToJSON(self):
 
         class Foo:
@@ -254,6 +803,7 @@ class TestStorage(TestCase):
             foo = 'bar'
 
         with Mock() as querySet:
+            querySet.all()
             querySet.filter(foo__contains='5')
             querySet.order_by('-foo')
             querySet.count() >> 1
@@ -266,16 +816,352 @@ class TestStorage(TestCase):
 
         querySet.validate()
 
+    def test_getKeysetPage(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+        User.objects.create_user('datable-b', 'b@bar.pl')
+        User.objects.create_user('datable-c', 'c@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            keysetPagination=True)
+        order_by = (s.getColumn('username'), False)
+
+        res = s.serializeToJSON({'start': '0', 'count': '2'}, order_by)
+        self.assertEquals(res['numRows'], 3)
+        self.assertEquals(
+            [x['username'] for x in res['items']], ['datable-a', 'datable-b'])
+
+        res = s.serializeToJSON(
+            {'start': '2', 'count': '2', 'cursor': res['cursor']}, order_by)
+        self.assertEquals(
+            [x['username'] for x in res['items']], ['datable-c'])
+
+    def test_getKeysetPage_modelOrdering(self):
+        s = storage.Storage(
+            Permission.objects.all(),
+            columns=[columns.StringColumn('codename')],
+            keysetPagination=True)
+        offset = storage.Storage(
+            Permission.objects.all(),
+            columns=[columns.StringColumn('codename')])
+
+        res = s.serializeToJSON({'start': '0', 'count': '3'})
+        self.assertEquals(
+            res['items'],
+            offset.serializeToJSON({'start': '0', 'count': '3'})['items'])
+
+        res = s.serializeToJSON(
+            {'start': '3', 'count': '3', 'cursor': res['cursor']})
+        self.assertEquals(
+            res['items'],
+            offset.serializeToJSON({'start': '3', 'count': '3'})['items'])
+
+    def test_getSeekOrder(self):
+        s = storage.Storage(
+            User.objects.all(), columns=[columns.StringColumn('username')])
+        self.assertEquals(
+            s.getSeekOrder(User.objects.order_by('-username')),
+            ['-username', '-pk'])
+        self.assertEquals(
+            s.getSeekOrder(User.objects.order_by('username', '-id')),
+            ['username', '-pk'])
+        self.assertEquals(s.getSeekOrder(User.objects.order_by()), ['pk'])
+        # Relations sort by the other model's ordering
+        self.assertEquals(
+            s.getSeekOrder(Permission.objects.order_by('content_type')),
+            None)
+
+    def test_getPage_deferredJoin(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+        User.objects.create_user('datable-b', 'b@bar.pl')
+        User.objects.create_user('datable-c', 'c@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            deferredJoin=True)
+
+        res = s.serializeToJSON(
+            {'start': '1', 'count': '2', 'sort': '-username'},
+            (s.getColumn('username'), True))
+        self.assertEquals(
+            [x['username'] for x in res['items']], ['datable-b', 'datable-a'])
+
+    def test_getCount_cached(self):
+        self.s.cacheName = 'test_getCount_cached'
+        self.s.countCacheTimeout = 60
+
+        with Mock() as querySet:
+            querySet.count() >> 5
+            querySet.count() >> 7
+
+        self.assertEquals(self.s.getCount(querySet, self.valueDict), (5, False))
+        self.assertEquals(
+            self.s.getCount(querySet, dict(self.valueDict, start='25')),
+            (5, False))
+
+        self.s.invalidateCache()
+        self.assertEquals(self.s.getCount(querySet, self.valueDict), (7, False))
+        querySet.validate()
+
+    def test_serializeToJSON_pageCache(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            cacheName='test_pageCache',
+            pageCacheTimeout=60)
+        self.assertEquals(s.getWatchedModels(), [User])
+
+        res = s.serializeToJSON({'start': '0', 'count': '25'})
+        self.assertEquals(res['numRows'], 1)
+        self.assertEquals(s.serializeToJSON({'start': '0', 'count': '25'}), res)
+        self.assertEquals(s.getCacheStats(), {'misses': 1, 'hits': 1})
+
+        # saving a model invalidates the cache
+        User.objects.create_user('datable-b', 'b@bar.pl')
+        res = s.serializeToJSON({'start': '0', 'count': '25'})
+        self.assertEquals(res['numRows'], 2)
+        self.assertEquals(s.getCacheStats(), {'misses': 2, 'hits': 1})
+
+    def test_serializeToJSON_pageCache_querySet(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+        User.objects.create_user('datable-b', 'b@bar.pl')
+
+        # Storages built per request, for different users
+        pages = [
+            storage.Storage(
+                User.objects.filter(username=name),
+                columns=[columns.StringColumn('username')],
+                cacheName='test_pageCache_querySet',
+                pageCacheTimeout=60).serializeToJSON({'start': '0'})
+            for name in ('datable-a', 'datable-b')]
+        self.assertEquals(
+            [page['items'][0]['username'] for page in pages],
+            ['datable-a', 'datable-b'])
+
+    def test_serializeToJSON_snapshotTooBig(self):
+        for name in ('datable-a', 'datable-b', 'datable-c'):
+            User.objects.create_user(name, 'a@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            cacheName='test_snapshotTooBig',
+            snapshotTimeout=60)
+        valueDict = {'start': '0', 'count': '2'}
+
+        maxBytes = snapshots.CacheSnapshots.maxBytes
+        snapshots.CacheSnapshots.maxBytes = 16
+        try:
+            # Primary keys (at most one more than fit), the count, the page
+            with self.assertNumQueries(3):
+                res = s.serializeToJSON(valueDict)
+            self.assertEquals(res['numRows'], 3)
+
+            # The snapshot is not taken again: the count and the page
+            with self.assertNumQueries(2):
+                self.assertEquals(s.serializeToJSON(valueDict), res)
+        finally:
+            snapshots.CacheSnapshots.maxBytes = maxBytes
+
+    def test_serializeToJSON_rowCache(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+        User.objects.create_user('datable-b', 'b@bar.pl')
+
+        serialized = []
+
+        class CountingSerializer(StringSerializer):
+            def serialize_value(self, value, output_format=None):
+                serialized.append(value)
+                return value
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.Column(
+                'username', serializer=CountingSerializer('username'),
+                sortable=True)],
+            cacheName='test_rowCache',
+            versionField='email',
+            rowCacheTimeout=60)
+
+        res = s.serializeToJSON({'start': '0', 'count': '1'})
+        self.assertEquals(serialized, ['datable-a'])
+
+        res = s.serializeToJSON({'start': '0', 'count': '2'})
+        self.assertEquals(serialized, ['datable-a', 'datable-b'])
+        self.assertEquals(
+            [x['username'] for x in res['items']], ['datable-a', 'datable-b'])
+        self.assertEquals(res['numRows'], 2)
+
+        # a new version of the row is serialized again
+        User.objects.filter(username='datable-a').update(email='c@bar.pl')
+        s.serializeToJSON({'start': '0', 'count': '2'})
+        self.assertEquals(len(serialized), 3)
+
+        stats = s.getCacheStats()
+        self.assertEquals((stats['rowHits'], stats['rowMisses']), (2, 3))
+
+    def test_getRowKey(self):
+        self.s.cacheName = 'test_getRowKey'
+        key = self.s.getRowKey(5, datetime(2010, 1, 2, 3, 4, 5))
+        # Valid in memcached
+        self.assertEquals(key.split(':')[-1].isalnum(), True)
+        self.assertNotIn(' ', key)
+        self.assertNotEquals(
+            key, self.s.getRowKey(5, datetime(2010, 1, 2, 3, 4, 6)))
+
+        # Tables with other columns and newer data use other keys
+        self.assertNotEquals(
+            key, storage.Storage(
+                None, columns=[columns.StringColumn('bar')],
+                cacheName='test_getRowKey',
+            ).getRowKey(5, datetime(2010, 1, 2, 3, 4, 5)))
+        self.s.invalidateCache()
+        self.assertNotEquals(
+            key, self.s.getRowKey(5, datetime(2010, 1, 2, 3, 4, 5)))
+
+    def test_getValidator(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            cacheName='test_getValidator',
+            versionField='email')
+
+        etag, counted = s.getValidator({'start': '0', 'count': '25'})
+        self.assertEquals(counted, (1, False))
+        self.assertEquals(s.getETag({'start': '0', 'count': '25'}), etag)
+
+        # The page reuses the count
+        with self.assertNumQueries(1):
+            res = s.serializeToJSON(
+                {'start': '0', 'count': '25'}, counted=counted)
+        self.assertEquals(res['numRows'], 1)
+
+    def test_probe(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            cacheName='test_probe',
+            versionField='email')
+
+        probe = s.probe({'start': '0', 'count': '25'})
+        self.assertEquals(probe['numRows'], 1)
+        self.assertEquals(s.probe({'start': '25'}), probe)
+
+        User.objects.filter(username='datable-a').update(email='b@bar.pl')
+        self.assertNotEquals(s.probe({})['version'], probe['version'])
+
+    def test_probe_withoutVersionField(self):
+        user = User.objects.create_user('datable-a', 'a@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            cacheName='test_probe_withoutVersionField')
+        version = s.probe({})['version']
+
+        # Neither the biggest primary key nor the count change
+        user.first_name = 'Joe'
+        user.save()
+        self.assertNotEquals(s.probe({})['version'], version)
+
+        # Changes can not be noticed without a cacheName
+        s.cacheName = None
+        self.assertEquals(s.probe({})['version'], None)
+
+    def test_serializeToJSON_delta(self):
+        a = User.objects.create_user('datable-a', 'a@bar.pl')
+        b = User.objects.create_user('datable-b', 'b@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('email')],
+            defaultSort='email',
+            cacheName='test_delta',
+            versionField='email',
+            deltaTimeout=60)
+
+        res = s.serializeToJSON({'start': '0', 'count': '10'})
+        self.assertFalse(res.get('delta'))
+
+        User.objects.filter(pk=b.pk).update(email='c@bar.pl')
+        res = s.serializeToJSON(
+            {'start': '0', 'count': '10', 'sync': res['syncToken']})
+        self.assertTrue(res['delta'])
+        self.assertEquals(res['updated'], [b.pk])
+        self.assertEquals((res['inserted'], res['deleted']), ([], []))
+        self.assertEquals(res['order'], [a.pk, b.pk])
+        self.assertEquals(
+            [x['email'] for x in res['items']], ['c@bar.pl'])
+
+        User.objects.filter(pk=a.pk).delete()
+        res = s.serializeToJSON(
+            {'start': '0', 'count': '10', 'sync': res['syncToken']})
+        self.assertEquals(res['deleted'], [a.pk])
+        self.assertEquals(res['numRows'], 1)
+
+        # Other windows (or unknown tokens) get the full page
+        res = s.serializeToJSON(
+            {'start': '1', 'count': '10', 'sync': res['syncToken']})
+        self.assertFalse(res.get('delta'))
+
+    def test_getCount_capped(self):
+        self.s.countCap = 10
+
+        with Mock() as sliced:
+            sliced.count() >> 11
+
+        with Mock() as querySet:
+            querySet.__getitem__(slice(None, 11, None)) >> sliced
+
+        self.assertEquals(self.s.getCount(querySet, self.valueDict), (10, True))
+        querySet.validate()
+
+    def test_extendCappedCount(self):
+        state = FilterState(start=5, count=5)
+        # Full pages: the grid can scroll a page further
+        self.assertEquals(
+            self.s.extendCappedCount(10, state, 5), (15, True))
+        state = FilterState(start=10, count=5)
+        self.assertEquals(
+            self.s.extendCappedCount(10, state, 5), (20, True))
+        # A short page is the last one
+        self.assertEquals(
+            self.s.extendCappedCount(10, state, 2), (12, False))
+
+    def test_serializeToJSON_capped(self):
+        for name in ('datable-a', 'datable-b', 'datable-c'):
+            User.objects.create_user(name, 'a@bar.pl')
+
+        s = storage.Storage(
+            User.objects.filter(username__startswith='datable-'),
+            columns=[columns.StringColumn('username')],
+            countCap=1)
+
+        res = s.serializeToJSON({'start': '0', 'count': '2'})
+        self.assertEquals((res['numRows'], res['numRowsCapped']), (4, True))
+
+        res = s.serializeToJSON({'start': '2', 'count': '2'})
+        self.assertEquals(res['numRows'], 3)
+        self.assertFalse(res.get('numRowsCapped'))
+
     def test_serializeToCSV(self):
 
         class Foo:
             foo = 'bar'
 
         with Mock() as querySet:
+            querySet.all()
             querySet.filter(foo__contains='5')
             querySet.order_by('-foo')
-            querySet.__getitem__(0) >> Foo()
-            querySet.__getitem__(1) >> StopIteration()
+            querySet.iterator(chunk_size=2000) >> iter([Foo()])
 
         self.s.querySet = querySet
         res = self.s.serializeToCSV(self.valueDict, (self.c, True))
@@ -287,10 +1173,10 @@ class TestStorage(TestCase):
             foo = 'bar'
 
         with Mock() as querySet:
+            querySet.all()
             querySet.filter(foo__contains='5')
             querySet.order_by('-foo')
-            querySet.__getitem__(0) >> Foo()
-            querySet.__getitem__(1) >> StopIteration()
+            querySet.iterator(chunk_size=2000) >> iter([Foo()])
 
         self.s.querySet = querySet
         res = self.s.serializeToXLS(self.valueDict, (self.c, True))
@@ -298,6 +1184,45 @@ class TestStorage(TestCase):
 
 
 
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.built = []
+
+        def factory():
+            self.built.append(1)
+            return table.Table(
+                name='registered',
+                storage=storage.Storage(
+                    User.objects.all(),
+                    columns=[columns.StringColumn('username')],
+                    widgets=[widgets.StringWidget('username')]))
+
+        registry.register('test_registry', factory)
+
+    def tearDown(self):
+        registry.clear()
+
+    def test_get(self):
+        t = registry.get('test_registry')
+        self.assertIs(registry.get('test_registry'), t)
+        self.assertEquals(self.built, [1])
+
+        s = t.getStorage()
+        self.assertEquals(s.getColumnIndex('username'), 0)
+        self.assertEquals(s.getWidget('username').getName(), 'username')
+        self.assertEquals(s.getWidget('no_such_widget'), None)
+
+        self.assertRaises(AttributeError, setattr, t, 'name', 'foo')
+        self.assertRaises(AttributeError, setattr, s, 'countCap', 10)
+
+    def test_get_unknown(self):
+        self.assertRaises(KeyError, registry.get, 'no_such_table')
+
+    def test_validate(self):
+        s = storage.Storage(None, columns=[])
+        self.assertRaises(ImproperlyConfigured, s.freeze)
+        self.assertFalse(s.frozen)
+
 # ###*  ##*# # # **# ** #* # **#* #**# #* *# *# *# * #**# *#* *#* #*
 
 class TestTable(TestCase):
@@ -312,7 +1237,8 @@ class TestTable(TestCase):
         self.s = storage.Storage(
             None,
             widgets=[self.w],
-            columns=[self.c]
+            columns=[self.c],
+            projectFields=False
             )
 
         self.t = table.Table(
@@ -347,13 +1273,35 @@ class TestTable(TestCase):
 
     def test_filterAndSort(self):
         with Mock() as storage:
-            storage.getColumns() >> []
-            storage.filterAndSort(self.requestDict, None)
+            storage.getColumn('foo') >> None
+            storage.getFilterState(self.requestDict, None) >> 'state'
+            storage.filterAndSort('state')
 
         self.t.storage = storage
         self.t.filterAndSort(self.fakeRequest)
         storage.validate()
 
+    def test_getCacheName(self):
+        self.assertEquals(self.s.cacheName, 'table')
+
+        # Tables of different models may share a name
+        users, groups = [
+            table.Table(name='table', storage=storage.Storage(
+                querySet, columns=[columns.StringColumn('pk')]))
+            for querySet in [User.objects.all(), Group.objects.all()]]
+        self.assertEquals(users.storage.cacheName, 'table,auth.User')
+        self.assertEquals(groups.storage.cacheName, 'table,auth.Group')
+
+    def test_frozenStorage(self):
+        # Registry factories may share a storage, frozen already
+        s = storage.Storage(
+            User.objects.all(), columns=[columns.StringColumn('username')],
+            cacheName='users')
+        s.freeze()
+
+        t = table.Table(name='other', storage=s)
+        self.assertEquals(t.storage.cacheName, 'users')
+
     def test_getExportFilename(self):
         self.t.filename = 'test-%Y'
         y = datetime.now().strftime('%Y')
@@ -366,6 +1314,94 @@ class TestTable(TestCase):
         self.assertIn('Content-Length: 4', str(res))
         self.assertIn('test', str(res))
 
+    def test_downloadResponse(self):
+        f, path = tempfile.mkstemp()
+        os.write(f, b'0123456789')
+        os.close(f)
+
+        try:
+            res = self.t.downloadResponse(
+                self.fakeRequest, path, formats.CSV, 'abc')
+            self.assertEquals(b''.join(res.streaming_content), b'0123456789')
+            self.assertEquals(res['Accept-Ranges'], 'bytes')
+
+            self.fakeRequest.META = {'HTTP_RANGE': 'bytes=2-4'}
+            res = self.t.downloadResponse(
+                self.fakeRequest, path, formats.CSV, 'abc')
+            self.assertEquals(res.status_code, 206)
+            self.assertEquals(res['Content-Range'], 'bytes 2-4/10')
+            self.assertEquals(b''.join(res.streaming_content), b'234')
+
+            self.fakeRequest.META = {'HTTP_RANGE': 'bytes=2-4',
+                                     'HTTP_IF_RANGE': '"other"'}
+            res = self.t.downloadResponse(
+                self.fakeRequest, path, formats.CSV, 'abc')
+            self.assertEquals(res.status_code, 200)
+
+            self.fakeRequest.META = {'HTTP_RANGE': 'bytes=20-'}
+            res = self.t.downloadResponse(
+                self.fakeRequest, path, formats.CSV, 'abc')
+            self.assertEquals(res.status_code, 416)
+        finally:
+            os.unlink(path)
+
+    def test_streamingResponse(self):
+        res = self.t.streamingResponse(iter([b'te', b'st']), formats.CSV)
+        self.assertEquals(b''.join(res), b'test')
+        self.assertFalse(res.has_header('Content-Length'))
+
+    def test_handleRequest_conditional(self):
+        User.objects.create_user('datable-a', 'a@bar.pl')
+
+        for versionField in ['date_joined', None]:
+            t = table.Table(
+                name='conditional',
+                storage=storage.Storage(
+                    User.objects.all(),
+                    columns=[columns.StringColumn('username')],
+                    versionField=versionField))
+
+            f = self.fakeRequest
+            f.GET = {'conditional': 'json'}
+            f.META = {}
+
+            response = t.handleRequest(f)
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response['Cache-Control'], 'no-cache')
+
+            f.META = {'HTTP_IF_NONE_MATCH': response['ETag']}
+            self.assertEquals(t.handleRequest(f).status_code, 304)
+
+            User.objects.create_user('datable-%s' % versionField, 'b@bar.pl')
+            self.assertEquals(t.handleRequest(f).status_code, 200)
+
+    def test_handleRequest_conditional_related(self):
+        t = table.Table(
+            name='conditional_related',
+            storage=storage.Storage(
+                Permission.objects.filter(codename='add_user'),
+                columns=[columns.Column(
+                    'content_type', sortable=False,
+                    serializer=ForeignKeySerializer(
+                        'content_type', StringSerializer('model')))],
+                versionField='codename'))
+
+        f = self.fakeRequest
+        f.GET = {'conditional_related': 'json'}
+        f.META = {}
+
+        response = t.handleRequest(f)
+        f.META = {'HTTP_IF_NONE_MATCH': response['ETag']}
+        self.assertEquals(t.handleRequest(f).status_code, 304)
+
+        # The permission and its versionField did not change
+        contentType = Permission.objects.get(codename='add_user').content_type
+        contentType.model = 'datable'
+        contentType.save()
+        response = t.handleRequest(f)
+        self.assertEquals(response.status_code, 200)
+        self.assertIn(b'datable', response.content)
+
     def test_willHandle(self):
         self.assertEquals(
             self.t.willHandle(self.fakeRequest),
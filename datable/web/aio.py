@@ -0,0 +1,55 @@
+"""Helpers for serving datables from asyncio (ASGI) code.
+
+Django's async ORM (QuerySet.acount, async iteration) is used when it is
+available. Everything else -- older Django versions, the cache, serializers
+which may touch the database -- runs in a worker thread, so the event loop
+is never blocked.
+"""
+
+import asyncio
+import functools
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+
+async def runSync(fun, *args, **kw):
+    """Run a blocking function without blocking the event loop.
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(fun)(*args, **kw)
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(fun, *args, **kw))
+
+
+async def acount(querySet):
+    if hasattr(querySet, 'acount'):
+        return await querySet.acount()
+    return await runSync(querySet.count)
+
+
+async def alist(querySet):
+    """Evaluate a QuerySet (or any iterable) to a list.
+    """
+    if hasattr(querySet, '__aiter__'):
+        return [model async for model in querySet]
+    return await runSync(list, querySet)
+
+
+_exhausted = object()
+
+
+async def aiterate(iterable):
+    """Turn a blocking iterable, like a streamed export, into an async one.
+    Every step runs in a worker thread.
+    """
+    iterator = await runSync(iter, iterable)
+    while True:
+        item = await runSync(next, iterator, _exhausted)
+        if item is _exhausted:
+            return
+        yield item
@@ -0,0 +1,119 @@
+"""Caching of data computed by a Storage, using Django's cache framework.
+
+Every key of a storage contains its generation number. Bumping the
+generation (see invalidate) makes all cached data of that storage stale
+at once, without having to know the keys.
+
+Generations may be bumped automatically, when models are saved or
+deleted (see watchModels). Hits and misses of cached data are counted
+per name (see getStats).
+"""
+
+import threading
+import time
+
+from django.core.cache import cache as defaultCache
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+GENERATION_TIMEOUT = 86400 * 30
+
+# Functions called with the name of invalidated data (see datable.web.push)
+listeners = []
+
+
+def makeKey(*parts):
+    return 'datable:' + ':'.join([str(part) for part in parts])
+
+
+def getGeneration(name, cache=None):
+    """Current generation number of the data named name.
+    """
+    if cache is None:
+        cache = defaultCache
+
+    key = makeKey('generation', name)
+    generation = cache.get(key)
+
+    if generation is None:
+        # Start from the clock, so a generation lost from the cache is
+        # never reused
+        cache.add(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+
+    return generation
+
+
+def invalidate(name, cache=None):
+    """Make all the cached data named name stale.
+    """
+    if cache is None:
+        cache = defaultCache
+
+    key = makeKey('generation', name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not in the cache (anymore)
+        cache.set(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+    for listener in listeners:
+        listener(name)
+
+
+_statsLock = threading.Lock()
+_stats = {}
+
+
+def record(name, kind, count=1):
+    """Count events, like 'hits' or 'misses', of the data named name.
+    """
+    with _statsLock:
+        counters = _stats.setdefault(name, {})
+        counters[kind] = counters.get(kind, 0) + count
+
+
+def getStats(name=None):
+    """Counters of the data named name (or of all names, by name)."""
+    with _statsLock:
+        if name is not None:
+            return dict(_stats.get(name, {}))
+        return dict([(key, dict(value)) for key, value in _stats.items()])
+
+
+def resetStats():
+    with _statsLock:
+        _stats.clear()
+
+
+_watchedLock = threading.Lock()
+_watched = set()
+
+
+def makeReceiver(name, cache):
+    def receiver(sender, **kw):
+        invalidate(name, cache)
+    return receiver
+
+
+def watchModels(name, models, cache=None):
+    """Invalidate the data named name whenever an instance of one of
+    models is saved or deleted. Calling this again for the same name and
+    model does nothing.
+
+    Keep in mind, that QuerySet.update, bulk_create and raw SQL do not
+    send any signals.
+    """
+    for model in models:
+        uid = 'datable:%s:%s.%s' % (
+            name, model._meta.app_label, model.__name__)
+
+        with _watchedLock:
+            if uid in _watched:
+                continue
+            _watched.add(uid)
+
+        receiver = makeReceiver(name, cache)
+        for signal in post_save, post_delete:
+            signal.connect(receiver, sender=model, weak=False,
+                           dispatch_uid=uid)
@@ -2,7 +2,7 @@
 # -*- encoding: utf-8 -*-
 
 from django.utils.text import capfirst
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext_lazy
 
 from datable.core.serializers import BooleanSerializer
 from datable.core.serializers import DateSerializer
@@ -29,7 +29,8 @@ class Column(object):
             self.label = label
 
         if self.label is None:
-            self.label = _(capfirst(self.name.replace("_", " ")))
+            # translated when displayed, tables may be built only once
+            self.label = ugettext_lazy(capfirst(self.name.replace("_", " ")))
 
         if width is not None:
             self.width = width
@@ -0,0 +1,240 @@
+"""Formatting values in the database, for Storage(databaseFormatting=True).
+
+Columns with plain serializers are compiled to a DatabasePlan. Instead of
+loading models and calling serializers, rows are fetched as tuples using
+QuerySet.values_list. Dates and date-times are formatted by the database,
+and format strings are built with Concat. What is left (translated labels
+for missing values and booleans) is done in Python. The output is the same
+as the serializers' output.
+
+If a column's serializer is not known here, or this Django version has no
+database functions, there is no plan and serializers are used as usual.
+Dates are formatted in Python on database backends, which can not
+format them.
+"""
+
+import re
+
+from django.db import connections
+from django.db.models import CharField as CharModelField
+from django.db.models import TextField
+from django.utils.translation import ugettext as _
+
+try:
+    from django.db.models import F
+    from django.db.models import Func
+    from django.db.models import Value
+    from django.db.models import CharField
+    from django.db.models.functions import Concat
+except ImportError:
+    # Django < 1.8: no database functions
+    Func = None
+
+from datable.core.serializers import BooleanSerializer
+from datable.core.serializers import DateSerializer
+from datable.core.serializers import DateTimeSerializer
+from datable.core.serializers import FormatStringSerializer
+from datable.core.serializers import ForeignKeySerializer
+from datable.core.serializers import PrimaryKeySerializer
+from datable.core.serializers import StringSerializer
+from datable.web.util import getRelatedModel
+from datable.web.util import resolveFieldPath
+
+# vendor: (function, date format, datetime format, format goes first)
+dateFunctions = {
+    'sqlite': ('strftime', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', True),
+    'postgresql': ('to_char', 'YYYY-MM-DD', 'YYYY-MM-DD HH24:MI:SS', False),
+    'mysql': ('DATE_FORMAT', '%Y-%m-%d', '%Y-%m-%d %H:%i:%s', False),
+}
+
+formatParts = re.compile(r'(%\([^)]+\)s|%%)')
+
+
+def formatDate(field, vendor, withTime):
+    """An expression formatting a date (or a date and time) field as text,
+    or None if the database can not do it."""
+    if vendor not in dateFunctions:
+        return None
+
+    function, dateFormat, dateTimeFormat, formatFirst = dateFunctions[vendor]
+    fmt = Value(dateFormat)
+    if withTime:
+        fmt = Value(dateTimeFormat)
+
+    args = [F(field), fmt]
+    if formatFirst:
+        args.reverse()
+
+    return Func(*args, function=function, output_field=CharField())
+
+
+def noDataOr(convert):
+    noData = _('[no data]')
+
+    def fun(value):
+        if value is None:
+            return noData
+        return convert(value)
+    return fun
+
+
+def identity(value):
+    return value
+
+
+class DatabaseColumn:
+    """Values to select for a column -- field names or expressions -- and
+    a function making the cell out of them."""
+
+    def __init__(self, selects, convert):
+        self.selects = selects
+        self.convert = convert
+
+
+def compileFieldSerializer(serializer, model, vendor, prefix):
+    if serializer.getRequiredFields() is None:
+        return None
+
+    klass = type(serializer)
+
+    field = prefix + serializer.field
+    if field != 'pk' and not field.endswith('__pk'):
+        modelField = resolveFieldPath(model, field)
+        if modelField is None:
+            return None
+
+        # The database has the related row's id, serializers show str()
+        # of the related model
+        if klass is not ForeignKeySerializer and \
+           getRelatedModel(modelField) is not None:
+            return None
+
+    if klass in (StringSerializer, PrimaryKeySerializer):
+        return DatabaseColumn([field], noDataOr(str))
+
+    if klass is BooleanSerializer:
+        yes = _('yes')
+        return DatabaseColumn(
+            [field], noDataOr(lambda value: yes if value else '-'))
+
+    if klass in (DateSerializer, DateTimeSerializer):
+        withTime = klass is DateTimeSerializer
+        expression = formatDate(field, vendor, withTime)
+        if expression is None:
+            return DatabaseColumn(
+                [field], noDataOr(serializer.serialize_value))
+        return DatabaseColumn([expression], noDataOr(identity))
+
+    if klass is ForeignKeySerializer:
+        return compileSerializer(
+            serializer.other_serializer, model, vendor,
+            field + '__')
+
+
+def compileFormatString(serializer, model, vendor, prefix):
+    keys = serializer.getRequiredFields()
+    if keys is None:
+        return None
+
+    modelFields = [resolveFieldPath(model, prefix + key) for key in keys]
+    if None in modelFields or [
+            x for x in modelFields if getRelatedModel(x) is not None]:
+        return None
+
+    parts = formatParts.split(serializer.format)
+    literals = parts[0::2]
+    canConcat = len(keys) > 1 or [x for x in literals if x]
+
+    if canConcat and '%' not in ''.join(literals) and not [
+            x for x in modelFields
+            if x.null or not isinstance(x, (CharModelField, TextField))]:
+        expressions = []
+        for no, part in enumerate(parts):
+            if part == '%%':
+                expressions.append(Value('%'))
+            elif no % 2:
+                expressions.append(F(prefix + part[2:-2]))
+            elif part:
+                expressions.append(Value(part))
+
+        return DatabaseColumn(
+            [Concat(*expressions, output_field=CharField())], identity)
+
+    # Fetch the values, format them in Python
+    format = serializer.format
+
+    def convert(*values):
+        return format % dict(zip(keys, values))
+
+    return DatabaseColumn([prefix + key for key in keys], convert)
+
+
+def compileSerializer(serializer, model, vendor, prefix=''):
+    """A DatabaseColumn giving the same output as serializer, or None.
+    """
+    klass = type(serializer)
+
+    if klass is FormatStringSerializer:
+        return compileFormatString(serializer, model, vendor, prefix)
+
+    if klass in (StringSerializer, PrimaryKeySerializer, BooleanSerializer,
+                 DateSerializer, DateTimeSerializer, ForeignKeySerializer):
+        return compileFieldSerializer(serializer, model, vendor, prefix)
+
+
+class DatabasePlan:
+    """I fetch rows of a QuerySet as tuples of serialized cells.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def valuesList(self, querySet, extra=('pk', )):
+        """A QuerySet of tuples: values of fields named in extra, then
+        values needed by the columns."""
+        annotations = {}
+        names = list(extra)
+
+        for colNo, column in enumerate(self.columns):
+            for selNo, select in enumerate(column.selects):
+                if isinstance(select, str):
+                    names.append(select)
+                else:
+                    alias = '_datable_%i_%i' % (colNo, selNo)
+                    annotations[alias] = select
+                    names.append(alias)
+
+        if annotations:
+            querySet = querySet.annotate(**annotations)
+
+        return querySet.values_list(*names)
+
+    def convertRow(self, values, extra=1):
+        """Turn a tuple from valuesList into a tuple of extra values and
+        a tuple of cells."""
+        cells = []
+        pos = extra
+        for column in self.columns:
+            size = len(column.selects)
+            cells.append(column.convert(*values[pos:pos + size]))
+            pos += size
+        return values[:extra], tuple(cells)
+
+
+def compilePlan(serializers, querySet):
+    """A DatabasePlan for serializers, or None if any of them can not be
+    handled in the database.
+    """
+    if Func is None:
+        return None
+
+    vendor = connections[querySet.db].vendor
+
+    columns = []
+    for serializer in serializers:
+        column = compileSerializer(serializer, querySet.model, vendor)
+        if column is None:
+            return None
+        columns.append(column)
+
+    return DatabasePlan(columns)
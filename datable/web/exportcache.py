@@ -0,0 +1,148 @@
+"""Exported files, cached on disk.
+
+Many users export the same filtered view within minutes. With
+Table.cacheExports, a finished export is kept in a file named after a
+key of the table's querySet, the format, the filters, the sort, the
+language, the columns and the data version (see Storage.probe). An
+identical request is then served from the file, without querying the
+rows again.
+
+Without a Storage.versionField, the data version notices inserts and
+deletes only (and changes reported by model signals, see
+Storage.watchModels), so a cached export may miss updated rows.
+
+Files are kept in DATABLE_EXPORT_DIR/export-cache, unless directory is
+set. They are evicted, least recently used first, when the directory
+grows over maxSize bytes. Every hit touches the file's modification time,
+as access times are often not updated by the file system. Files not used
+for maxAge seconds are stale, which bounds how long updated rows can be
+missed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from django.utils.translation import get_language
+
+from datable.core import formats
+from datable.web.util import getExportDirectory
+
+directory = None  # None means 'export-cache' in DATABLE_EXPORT_DIR
+maxSize = 512 * 1024 * 1024  # bytes
+maxAge = 3600  # seconds a file is used for since its last use
+
+
+def getDirectory():
+    return getExportDirectory('export-cache', directory)
+
+
+def isExpired(mtime, now=None):
+    if now is None:
+        now = time.time()
+    return maxAge is not None and now - mtime > maxAge
+
+
+def getKey(storage, state, output_format):
+    """Key of an export of storage's rows for state; it changes with
+    the data. Costs a single aggregate query."""
+    version = storage.probe(state)['version']
+    if version is None:
+        # Changes can not be noticed, so the export is never reused
+        version = uuid.uuid4().hex
+
+    # The querySet may depend on the request (like rows of request.user)
+    data = [storage.getQueryKey(), version,
+            state.getSortKey(), formats.getExtension(output_format),
+            get_language(), storage.title, storage.getHeader()]
+    return hashlib.sha1(json.dumps(
+        data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def getPath(key, output_format):
+    return os.path.join(
+        getDirectory(), key + '.' + formats.getExtension(output_format))
+
+
+def lookup(key, output_format):
+    """Path of the cached export, or None if it is not cached or stale.
+    """
+    path = getPath(key, output_format)
+    try:
+        if isExpired(os.path.getmtime(path)):
+            return None
+        # Most recently used
+        os.utime(path, None)
+    except OSError:
+        return None
+    return path
+
+
+def store(key, output_format, write):
+    """Cache an export written by write(fileobj); returns its path.
+    Readers never see a partially written file."""
+    path = getPath(key, output_format)
+
+    fd, tmp = tempfile.mkstemp(dir=getDirectory(), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    evict(keep=path)
+    return path
+
+
+def fetch(storage, state, output_format, key=None):
+    """Path of the cached export for state, exporting it first if it is
+    not cached."""
+    if key is None:
+        key = getKey(storage, state, output_format)
+
+    path = lookup(key, output_format)
+    if path is None:
+        path = store(key, output_format, lambda f: storage.exportToFile(
+            state, output_format, f))
+    return path
+
+
+def evict(keep=None):
+    """Remove stale files, then least recently used files, until all
+    files take at most maxSize bytes. The file keep is never removed."""
+    path = getDirectory()
+    now = time.time()
+
+    files = []
+    total = 0
+    for name in os.listdir(path):
+        if name.endswith('.tmp'):
+            continue
+
+        filename = os.path.join(path, name)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            # Removed by another process
+            continue
+
+        files.append((stat.st_mtime, stat.st_size, filename))
+        total += stat.st_size
+
+    files.sort()
+    for mtime, size, filename in files:
+        if total <= maxSize and not isExpired(mtime, now):
+            break
+        if filename == keep:
+            continue
+
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+        total -= size
@@ -94,9 +94,21 @@ class PeriodicRefreshWidget(BooleanWidget):
     templateName = "periodic_refresh"
     filterClass = NoFilter
 
-    def exportDescription(self, requestDict):
+    def describeValue(self, value):
         return
 
 
 class PeriodicOlderThanNowRefreshWidget(PeriodicRefreshWidget):
     filterClass = OlderThanNow
+
+
+class PushRefreshWidget(BooleanWidget):
+    """Refresh the grid when the server says its rows changed, instead
+    of polling. The table's storage needs pushEvents=True (see
+    datable.web.push)."""
+    placeholder = _("Refresh on changes")
+    templateName = "push_refresh"
+    filterClass = NoFilter
+
+    def describeValue(self, value):
+        return
@@ -0,0 +1,235 @@
+"""Exports running in the background.
+
+Big exports take longer than a proxy waits for a response. Instead of
+exporting within the request, a table with backgroundExports=True starts
+a job on ?<table>=job&export=<format> and returns its id at once. The job
+runs in a pool thread and writes the file to the export directory. The
+browser polls ?<table>=jobstatus&job=<id> for progress and downloads the
+file from ?<table>=jobfile&job=<id> when it is done.
+
+The state of a job is kept in a JSON file next to the exported file, so
+any process serving the table can report it, as long as they share the
+directory: DATABLE_EXPORT_DIR/jobs, unless directory is set. Jobs are
+lost when the process running them stops. Files of jobs older than maxAge
+seconds are removed when new jobs start.
+"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.utils import translation
+
+from datable.core import formats
+from datable.web import exportcache
+from datable.web import parallel
+from datable.web.util import getExportDirectory
+
+logger = logging.getLogger(__name__)
+
+directory = None  # None means 'jobs' in the DATABLE_EXPORT_DIR setting
+maxWorkers = 2  # exports running at the same time
+maxAge = 86400  # seconds to keep files of finished jobs for
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+jobIdFormat = re.compile('^[0-9a-f]{32}$')
+
+exportFormats = (formats.XLS, formats.XLSX, formats.CSV)
+
+_executor = None
+_lock = threading.Lock()
+
+
+def getExecutor():
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        return _executor
+
+
+def shutdown(wait=True):
+    global _executor
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+
+def getDirectory():
+    return getExportDirectory('jobs', directory)
+
+
+def isValidId(jobId):
+    """Job ids are checked before they are used in paths."""
+    return bool(jobId) and jobIdFormat.match(jobId) is not None
+
+
+def getPath(jobId, suffix):
+    if not isValidId(jobId):
+        raise ValueError("Invalid job id %r" % jobId)
+    return os.path.join(getDirectory(), jobId + '.' + suffix)
+
+
+def getDataPath(jobId, output_format):
+    return getPath(jobId, formats.getExtension(output_format))
+
+
+def readState(jobId):
+    """The state of a job, as a dict, or None if there is no such job.
+    """
+    if not isValidId(jobId):
+        return None
+
+    try:
+        with open(getPath(jobId, 'json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def writeState(state):
+    """Write the state of a job; readers never see a partial file."""
+    state['updated'] = time.time()
+
+    fd, tmp = tempfile.mkstemp(dir=getDirectory(), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, getPath(state['id'], 'json'))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def start(table, filterState, output_format):
+    """Queue an export of table's rows for filterState; returns the
+    state of the new job."""
+    if output_format not in exportFormats:
+        raise formats.UnknownFormat(output_format)
+
+    purge()
+
+    state = dict(
+        id=uuid.uuid4().hex,
+        table=table.name,
+        format=formats.getExtension(output_format),
+        status=QUEUED,
+        rows=0,
+        total=None,
+        error=None,
+        created=time.time())
+    writeState(state)
+
+    getExecutor().submit(
+        run, dict(state), table, filterState, output_format,
+        translation.get_language())
+    return state
+
+
+def run(state, table, filterState, output_format, language):
+    """Export to the job's file, updating its state as rows are written.
+    """
+    storage = table.getStorage()
+    path = getDataPath(state['id'], output_format)
+
+    def progress(rows):
+        state['rows'] = rows
+        writeState(state)
+
+    try:
+        with translation.override(language):
+            state['status'] = RUNNING
+            state['total'] = storage.getCount(
+                storage.filterQuerySet(filterState), filterState)[0]
+            writeState(state)
+
+            if getattr(table, 'cacheExports', False):
+                rows = exportCached(
+                    state, storage, filterState, output_format, progress)
+            else:
+                with open(path, 'wb') as f:
+                    rows = storage.exportToFile(
+                        filterState, output_format, f, progress)
+
+        state['rows'] = rows
+        state['status'] = DONE
+
+    except Exception as e:
+        logger.exception("%s: export job %s failed", table, state['id'])
+        state['status'] = FAILED
+        state['error'] = str(e)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    finally:
+        parallel.closeConnections()
+
+    writeState(state)
+
+
+def exportCached(state, storage, filterState, output_format, progress):
+    """Export to the export cache, unless the file is there already;
+    see datable.web.exportcache. Returns the number of rows."""
+    key = state['key'] = exportcache.getKey(
+        storage, filterState, output_format)
+    if exportcache.lookup(key, output_format) is not None:
+        return state['total']
+
+    exported = [0]
+
+    def write(f):
+        exported[0] = storage.exportToFile(
+            filterState, output_format, f, progress)
+
+    exportcache.store(key, output_format, write)
+    return exported[0]
+
+
+def getFile(jobId):
+    """Path of a finished job's file and its format, or None."""
+    state = readState(jobId)
+    if state is None or state['status'] != DONE:
+        return None
+
+    output_format = formats.getFormat(state['format'])
+    if state.get('key'):
+        path = exportcache.lookup(state['key'], output_format)
+        if path is None:
+            # Evicted in the meantime
+            return None
+        return path, output_format
+
+    return getDataPath(jobId, output_format), output_format
+
+
+def purge():
+    """Remove files of jobs older than maxAge seconds."""
+    path = getDirectory()
+    now = time.time()
+
+    for name in os.listdir(path):
+        jobId = name.split('.')[0]
+        if not isValidId(jobId):
+            continue
+
+        filename = os.path.join(path, name)
+        try:
+            if now - os.path.getmtime(filename) > maxAge:
+                os.unlink(filename)
+        except OSError:
+            # Removed by another process
+            pass
@@ -0,0 +1,191 @@
+"""Pagination of large QuerySets.
+
+Keyset (seek) pagination: instead of skipping `start` rows with OFFSET,
+the database seeks past the last row of the previous page, using the
+QuerySet's ordering (the sort column or the model's Meta.ordering) and the
+primary key as a tiebreaker.
+
+Deferred join: when OFFSET can not be avoided, only primary keys are
+scanned; whole rows are loaded for the keys of the page only.
+"""
+
+import base64
+import json
+
+from datetime import date
+from datetime import datetime
+from datetime import time
+from decimal import Decimal
+from uuid import UUID
+
+from django.db.models import Q
+from iso8601 import parse_date
+
+
+def getAttribute(model, path):
+    """Follow a QuerySet lookup path like 'book_type__name' on a model.
+    """
+    value = model
+    for name in path.split('__'):
+        if value is None:
+            return None
+        value = getattr(value, name)
+    return value
+
+
+def encodeValue(value):
+    if isinstance(value, datetime):
+        return ['datetime', value.isoformat()]
+    if isinstance(value, date):
+        return ['date', value.strftime("%Y-%m-%d")]
+    if isinstance(value, time):
+        return ['time', value.isoformat()]
+    if isinstance(value, Decimal):
+        return ['decimal', str(value)]
+    if isinstance(value, UUID):
+        return ['uuid', str(value)]
+    if isinstance(value, (bool, int, float, str)):
+        return ['value', value]
+    raise TypeError("Can not encode %r in a cursor" % type(value))
+
+
+def parseTime(value):
+    """Parse time.isoformat(): HH:MM:SS[.ffffff][+HH:MM]"""
+    for format in ("%H:%M:%S.%f%z", "%H:%M:%S%z", "%H:%M:%S.%f",
+                   "%H:%M:%S", "%H:%M"):
+        try:
+            parsed = datetime.strptime(value, format)
+        except ValueError:
+            continue
+        return parsed.timetz()
+    raise ValueError("Invalid time %r" % value)
+
+
+def decodeValue(kind, value):
+    if kind == 'datetime':
+        return parse_date(value, None)
+    if kind == 'date':
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    if kind == 'time':
+        return parseTime(value)
+    if kind == 'decimal':
+        return Decimal(value)
+    if kind == 'uuid':
+        return UUID(value)
+    if kind == 'value':
+        return value
+    raise ValueError("Unknown cursor value kind %r" % kind)
+
+
+class Cursor:
+    """Position of the last row of a page: its index in the result (the
+    `start` value of the next page) and its values of the ordering, a list
+    of names like '-name', ending with the primary key. It also remembers
+    the ordering and a filter key, so it is never applied to a differently
+    filtered or sorted QuerySet.
+    """
+
+    def __init__(self, position, values, order, filterKey):
+        self.position = position
+        self.values = list(values)
+        self.order = list(order)
+        self.filterKey = filterKey
+
+    def encode(self):
+        data = [self.position, [encodeValue(v) for v in self.values],
+                self.order, self.filterKey]
+        return base64.urlsafe_b64encode(
+            json.dumps(data).encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def decode(klass, token):
+        """Returns a Cursor, or None if the token is missing or invalid.
+        """
+        if not token:
+            return None
+
+        try:
+            data = json.loads(
+                base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+            position, values, order, filterKey = data
+            if len(values) != len(order):
+                return None
+            return klass(int(position),
+                         [decodeValue(*value) for value in values],
+                         [str(name) for name in order], filterKey)
+        except (TypeError, ValueError, UnicodeError):
+            return None
+
+    def matches(self, position, order, filterKey):
+        return self.position == position and self.order == list(order) and \
+            self.filterKey == filterKey
+
+
+def getOrdering(querySet):
+    """The ordering querySet is sorted by: its order_by, or else the
+    model's Meta.ordering, as a list of names like '-name'. None, if it
+    orders by expressions."""
+    query = querySet.query
+    if query.extra_order_by:
+        return None
+
+    if query.order_by:
+        ordering = query.order_by
+    elif query.default_ordering:
+        ordering = querySet.model._meta.ordering
+    else:
+        ordering = []
+
+    for name in ordering:
+        if not isinstance(name, str):
+            return None
+    return list(ordering)
+
+
+def getSeekField(name):
+    """Field name and direction of an ordering name like '-name'."""
+    if name.startswith('-'):
+        return name[1:], True
+    return name, False
+
+
+def orderForSeek(querySet, order):
+    """Order querySet by order, which ends with the primary key, so the
+    ordering is total and a row can be found by its values of it."""
+    return querySet.order_by(*order)
+
+
+def seek(querySet, cursor):
+    """Filter an orderForSeek-ordered querySet to rows after cursor: rows
+    with the same values of the first fields of the ordering and a later
+    value of the next one.
+    """
+    condition = None
+    equal = {}
+
+    for name, value in zip(cursor.order, cursor.values):
+        field, desc = getSeekField(name)
+        op = 'gt'
+        if desc:
+            op = 'lt'
+
+        after = dict(equal)
+        after[field + '__' + op] = value
+        if condition is None:
+            condition = Q(**after)
+        else:
+            condition = condition | Q(**after)
+        equal[field] = value
+
+    return querySet.filter(condition)
+
+
+def fetchByPrimaryKeys(querySet, pks):
+    """Rows of querySet with given primary keys, in the order of pks.
+    Rows, which no longer exist, are skipped.
+    """
+    if not pks:
+        return []
+
+    rows = dict((model.pk, model) for model in querySet.filter(pk__in=pks))
+    return [rows[pk] for pk in pks if pk in rows]
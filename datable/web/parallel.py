@@ -0,0 +1,85 @@
+"""Running database queries concurrently.
+
+Django keeps a database connection per thread, so a query submitted here
+runs on a connection of its own. Like at the start and end of a request,
+connections of pool threads are closed around every task when they are
+broken or older than CONN_MAX_AGE, and reused otherwise.
+
+Keep in mind, that queries run this way do not share the transaction of
+the calling thread, so they will not see its uncommitted changes.
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6: connections are not persistent
+    def close_old_connections():
+        for connection in connections.all():
+            connection.close()
+
+maxWorkers = 4
+
+_executor = None
+_lock = threading.Lock()
+
+
+def getExecutor():
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        return _executor
+
+
+def shutdown(wait=True):
+    global _executor
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+
+def closeConnections():
+    """Close this thread's connections, which Django would close at the
+    end of a request."""
+    close_old_connections()
+
+
+def _call(fun, args, kw):
+    closeConnections()
+    try:
+        return fun(*args, **kw)
+    finally:
+        closeConnections()
+
+
+def submit(fun, *args, **kw):
+    """Call fun(*args, **kw) in a pool thread; returns a Future.
+    """
+    return getExecutor().submit(_call, fun, args, kw)
+
+
+def callWith(future, fun, *args, **kw):
+    """Call fun(*args, **kw) in this thread while the future runs, then
+    return a tuple of both results. If fun raises, the future is cancelled
+    (when it has not started yet) and the exception is re-raised; if the
+    future raises, its exception is re-raised. When the future does not
+    finish in timeout seconds, concurrent.futures.TimeoutError is raised.
+    """
+    timeout = kw.pop('timeout', None)
+
+    try:
+        result = fun(*args, **kw)
+    except Exception:
+        future.cancel()
+        raise
+
+    return future.result(timeout), result
@@ -0,0 +1,245 @@
+"""Pushing change notifications to grids, with Server-Sent Events.
+
+A grid with a PushRefreshWidget opens an EventSource on ?<table>=events.
+Whenever the storage's data is invalidated (by model signals, see
+Storage.watchModels, or by Storage.invalidateCache), the storage's channel
+is published on the broker. Every open stream then probes the storage
+under its own filters (see Storage.probe) and sends a 'changed' event only
+if the probe's version changed.
+
+Notifications are coalesced: a stream sends at most one event every
+minInterval seconds, and probes once for all notifications which came in
+the meantime. Probe results are cached per filter and cache generation, so
+streams with the same filters share the probe query.
+
+LocalBroker works within a single process (and in tests). For deployments
+with many processes, use CacheBroker (which polls a shared Django cache)
+or any object with the same publish, current and wait methods:
+
+    push.setBroker(MyRedisBroker())
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+from django.db import connections
+
+from datable.web import aio
+from datable.web import cache
+
+minInterval = 2.0  # seconds between events of a stream
+heartbeat = 15.0  # seconds between keep-alive comments
+maxDuration = 300.0  # seconds; then the browser reconnects
+pollInterval = 0.5  # seconds between checks of the broker, in async streams
+retry = 3000  # milliseconds, before the browser reconnects
+
+
+class LocalBroker(object):
+    """I keep a counter of notifications for every channel, in memory.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+
+    def publish(self, channel):
+        with self.condition:
+            self.versions[channel] = self.versions.get(channel, 0) + 1
+            self.condition.notify_all()
+
+    def current(self, channel):
+        with self.condition:
+            return self.versions.get(channel, 0)
+
+    def wait(self, channel, since, timeout=None):
+        """Wait until the channel's counter is different than since, or
+        for timeout seconds; returns the counter."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self.condition:
+            while self.versions.get(channel, 0) == since:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self.condition.wait(remaining)
+            return self.versions.get(channel, 0)
+
+
+class CacheBroker(object):
+    """I keep counters in a Django cache shared by many processes; waiting
+    is done by polling the cache every pollInterval seconds."""
+
+    pollInterval = 1.0
+
+    def __init__(self, backend=None, pollInterval=None):
+        self.backend = backend
+        if self.backend is None:
+            self.backend = cache.defaultCache
+
+        if pollInterval is not None:
+            self.pollInterval = pollInterval
+
+    def getKey(self, channel):
+        return cache.makeKey('push', channel)
+
+    def publish(self, channel):
+        key = self.getKey(channel)
+        try:
+            self.backend.incr(key)
+        except ValueError:
+            self.backend.set(key, int(time.time() * 1000),
+                             cache.GENERATION_TIMEOUT)
+
+    def current(self, channel):
+        return self.backend.get(self.getKey(channel)) or 0
+
+    def wait(self, channel, since, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            version = self.current(channel)
+            if version != since:
+                return version
+
+            delay = self.pollInterval
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    return version
+            time.sleep(delay)
+
+
+_broker = LocalBroker()
+
+
+def getBroker():
+    return _broker
+
+
+def setBroker(broker):
+    global _broker
+    _broker = broker
+
+
+def publish(name):
+    """Notify streams of the storage named name, that its data changed.
+    """
+    getBroker().publish(name)
+
+
+# Invalidated storages are published
+cache.listeners.append(publish)
+
+
+def formatEvent(event, data):
+    return ('event: %s\ndata: %s\n\n' % (
+        event, json.dumps(data))).encode('utf-8')
+
+
+def releaseConnection(storage):
+    """Close the database connection between probes, so idle streams do
+    not keep connections open; not within a transaction."""
+    connection = connections[storage.querySet.db]
+    if not getattr(connection, 'in_atomic_block', False):
+        connection.close()
+
+
+def getVersion(storage, state):
+    """The storage's probe version for state. Probes are cached per
+    filters and cache generation, so streams share them."""
+    key = cache.makeKey(
+        'probe', storage.cacheName, storage.getGeneration(), state.filterKey)
+    backend = storage.getCache()
+
+    version = backend.get(key)
+    if version is None:
+        version = storage.probe(state)['version']
+        backend.set(key, version, int(maxDuration))
+        releaseConnection(storage)
+    return version
+
+
+def eventStream(storage, state, broker=None):
+    """Yield Server-Sent Events for a grid showing state, for at most
+    maxDuration seconds."""
+    if broker is None:
+        broker = getBroker()
+
+    channel = storage.cacheName
+    if not storage.watching:
+        storage.watchModels()
+
+    started = time.time()
+    seen = broker.current(channel)
+    version = getVersion(storage, state)
+    sent = 0
+
+    yield ('retry: %i\n' % retry).encode('utf-8') + \
+        formatEvent('version', {'version': version})
+
+    while time.time() - started < maxDuration:
+        current = broker.wait(channel, seen, heartbeat)
+        if current == seen:
+            yield b': keep-alive\n\n'
+            continue
+
+        # Coalesce notifications coming in until the next event may be sent
+        delay = sent + minInterval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        seen = broker.current(channel)
+
+        newVersion = getVersion(storage, state)
+        if newVersion != version:
+            version = newVersion
+            sent = time.time()
+            yield formatEvent('changed', {'version': version})
+
+
+async def aeventStream(storage, state, broker=None):
+    """eventStream for asyncio. The broker is polled every pollInterval
+    seconds, instead of keeping a thread waiting for every stream."""
+    if broker is None:
+        broker = getBroker()
+
+    channel = storage.cacheName
+    if not storage.watching:
+        storage.watchModels()
+
+    started = time.time()
+    seen = await aio.runSync(broker.current, channel)
+    version = await aio.runSync(getVersion, storage, state)
+    sent = 0
+    beat = started
+
+    yield ('retry: %i\n' % retry).encode('utf-8') + \
+        formatEvent('version', {'version': version})
+
+    while time.time() - started < maxDuration:
+        await asyncio.sleep(pollInterval)
+
+        current = await aio.runSync(broker.current, channel)
+        if current == seen:
+            if time.time() - beat >= heartbeat:
+                beat = time.time()
+                yield b': keep-alive\n\n'
+            continue
+
+        delay = sent + minInterval - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        seen = await aio.runSync(broker.current, channel)
+
+        newVersion = await aio.runSync(getVersion, storage, state)
+        if newVersion != version:
+            version = newVersion
+            sent = beat = time.time()
+            yield formatEvent('changed', {'version': version})
@@ -0,0 +1,83 @@
+"""Tables, which are defined once and shared by all requests.
+
+Building a Table -- with its storage, columns, widgets and the storages
+of autocomplete widgets -- for every request is a waste of time. Instead,
+register a function building the table:
+
+    def booksTable():
+        return Table(name='books', storage=Storage(...))
+
+    registry.register('books', booksTable)
+
+and look the table up in the view:
+
+    def books(request):
+        table = registry.get('books')
+        ...
+
+The table is built, validated and frozen (see Storage.freeze) the first
+time it is needed, or by build(), which may be called at startup (for
+example, from urls.py) to find errors in definitions early. Frozen tables
+can not be changed, so they can be shared by threads.
+
+Labels are translated when a table is displayed, not when it is built,
+so use ugettext_lazy in table definitions.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+_factories = OrderedDict()
+_tables = {}
+_lock = threading.RLock()
+
+
+def register(name, factory):
+    """Register a function returning a Table, to be built once.
+    Registering a name again replaces the table.
+    """
+    with _lock:
+        _factories[name] = factory
+        _tables.pop(name, None)
+
+
+def table(name):
+    """A decorator version of register."""
+    def decorator(factory):
+        register(name, factory)
+        return factory
+    return decorator
+
+
+def get(name):
+    """The built table registered as name; raises KeyError if there is
+    no such table."""
+    table = _tables.get(name)
+    if table is not None:
+        return table
+
+    with _lock:
+        table = _tables.get(name)
+        if table is None:
+            table = _tables[name] = buildTable(_factories[name])
+        return table
+
+
+def buildTable(factory):
+    table = factory()
+    table.freeze()
+    return table
+
+
+def build():
+    """Build all registered tables, which were not built yet."""
+    for name in list(_factories.keys()):
+        get(name)
+
+
+def clear():
+    """Forget all built tables; they will be built again when needed.
+    """
+    with _lock:
+        _tables.clear()
@@ -2,8 +2,12 @@
 from dojango.util import to_dojo_data
 
 from datable.core import formats
+from datable.core import xlsx
 from datable.core.serializers import QuerySetSerializer
 
+from datetime import date
+from datetime import datetime
+from io import BytesIO
 from io import StringIO
 
 import xlwt
@@ -22,20 +26,80 @@ class JSONQuerySetSerializer(QuerySetSerializer):
         return result
 
     def serialize(self, querySet, totalRows):
+        if self.databasePlan is not None:
+            convertRow = self.databasePlan.convertRow
+            rows = []
+            identifiers = []
+            for values in querySet:
+                (pk, ), row = convertRow(values)
+                rows.append(row)
+                identifiers.append(pk)
+        else:
+            models = list(querySet)
+            rows = self.serializeBatch(models)
+            identifiers = [getattr(model, self.identifier)
+                           for model in models]
+
+        return self.serializeCells(list(zip(identifiers, rows)), totalRows)
+
+    def serializeCells(self, rows, totalRows):
+        """Build the response out of already serialized rows, a list of
+        (identifier, tuple of cells) pairs."""
+        names = self.names + (self.identifier, )
+
         return to_dojo_data(
-            list(QuerySetSerializer.serialize(self, querySet)),
+            [dict(list(zip(names, row + (pk, ))))
+             for pk, row in rows],
             identifier=self.identifier,
             num_rows=totalRows)
 
-class XLSQuerySetSerializer(QuerySetSerializer):
+class SheetsMixin:
+    """Data, which does not fit in a sheet, continues on more sheets."""
+
+    maxTitle = 31  # characters in a sheet name
+
+    def getSheetTitle(self, title, number):
+        """Name of the number-th sheet: the title, then continuations
+        like 'title (2)'."""
+        if number == 1:
+            return title[:self.maxTitle]
+        suffix = ' (%i)' % number
+        return title[:self.maxTitle - len(suffix)] + suffix
+
+
+class XLSQuerySetSerializer(SheetsMixin, QuerySetSerializer):
     output_format = formats.XLS
+    maxRows = 65536  # rows per sheet; more go to continuation sheets
+
+    # Number formats of native values; other values use the default style
+    numberFormats = [
+        (datetime, 'YYYY-MM-DD HH:MM:SS'),
+        (date, 'YYYY-MM-DD'),
+    ]
+
+    def __init__(self, *args, **kw):
+        QuerySetSerializer.__init__(self, *args, **kw)
+        self.styles = {}
+
+    def getStyle(self, value):
+        """An XFStyle for value, created once per type and reused."""
+        klass = type(value)
+        style = self.styles.get(klass)
+        if style is None:
+            style = self.styles[klass] = xlwt.XFStyle()
+            for base, numberFormat in self.numberFormats:
+                if issubclass(klass, base):
+                    style.num_format_str = numberFormat
+                    break
+        return style
 
     def serialize(self, querySet, title, header, exportDescription):
-        """Serialize data to XLS.
-        XXX: TODO: Currently, this is memory-inefficient.
+        """Serialize data to XLS. Numbers, dates and booleans are written
+        as native cells. Sheets are limited to maxRows rows, so the data
+        continues on more sheets, each starting with the header.
         """
         book = xlwt.Workbook(encoding='utf-8')
-        sheet = book.add_sheet(title)
+        sheet = book.add_sheet(self.getSheetTitle(title, 1))
 
         cur_row = 0
 
@@ -46,22 +110,80 @@ class XLSQuerySetSerializer(QuerySetSerializer):
 
         cur_row += 1
 
-        for col_no, col in enumerate(header):
-            sheet.write(cur_row, col_no, header[col_no])
+        def writeHeader(sheet, cur_row):
+            for col_no, col in enumerate(header):
+                sheet.write(cur_row, col_no, col)
+            return cur_row + 1
+
+        cur_row = writeHeader(sheet, cur_row)
+        sheets = 1
+        getStyle = self.getStyle
+
+        for row in self.nativeRows(querySet):
+            if cur_row >= self.maxRows:
+                sheets += 1
+                sheet = book.add_sheet(self.getSheetTitle(title, sheets))
+                cur_row = writeHeader(sheet, 0)
 
-        for row_no, row in enumerate(
-            QuerySetSerializer.serialize(self, querySet)):
-            for col_no, col in enumerate(row.keys()):
-                sheet.write(cur_row + row_no + 1, col_no, row[col])
+            sheetRow = sheet.row(cur_row)
+            for col_no, value in enumerate(row):
+                sheetRow.write(col_no, value, getStyle(value))
+            cur_row += 1
+
+            # Rows are not needed after they are written
+            if cur_row % 1000 == 0:
+                sheet.flush_row_data()
 
-        output = StringIO()
+        output = BytesIO()
         book.save(output)
         output.seek(0)
         return output
 
 
+class XLSXQuerySetSerializer(SheetsMixin, QuerySetSerializer):
+    output_format = formats.XLSX
+    maxTitle = xlsx.MAX_TITLE
+    chunkRows = 100  # rows written per chunk, when streaming
+
+    def stream(self, querySet, title, header, exportDescription):
+        """Serialize data to XLSX, yielding parts of the zip archive as
+        rows are written. Memory does not grow with the number of rows.
+        Numbers, dates and booleans are written as native cells. As in
+        XLS, rows which do not fit in a sheet (xlsx.MAX_ROWS) continue on
+        more sheets, each starting with the header.
+        """
+        book = xlsx.Workbook(self.getSheetTitle(title, 1))
+        header = [str(v) for v in header]
+
+        for row in exportDescription:
+            book.writeRow(row)
+
+        book.writeRow(())
+        book.writeRow(header, bold=True)
+        yield book.read()
+
+        rows = 0
+        sheets = 1
+        for row in self.nativeRows(querySet):
+            if not book.rowsLeft():
+                sheets += 1
+                book.addSheet(self.getSheetTitle(title, sheets))
+                book.writeRow(header, bold=True)
+
+            book.writeRow(row)
+            rows += 1
+            if rows % self.chunkRows == 0:
+                data = book.read()
+                if data:
+                    yield data
+
+        book.close()
+        yield book.read()
+
+
 class CSVQuerySetSerializer(QuerySetSerializer):
     output_format = formats.CSV
+    chunkRows = 100  # rows encoded per chunk, when streaming
 
     def serialize(self, querySet, title, header, exportDescription):
         """Serialize data to CSV
@@ -73,11 +195,40 @@ class CSVQuerySetSerializer(QuerySetSerializer):
         for row in exportDescription:
             csv_writer.writerow(row)
 
-        csv_writer.writerow([str(v).encode('utf8') for v in header])
+        csv_writer.writerow([str(v) for v in header])
 
-        for elem in QuerySetSerializer.serialize(self, querySet):
-            csv_writer.writerow(
-                [str(v).encode('utf8') for v in list(elem.values())])
+        for row in self.serializeRows(querySet):
+            csv_writer.writerow([str(v) for v in row])
 
         a.seek(0)
         return a
+
+    def stream(self, querySet, title, header, exportDescription):
+        """Serialize data to CSV, yielding UTF-8 encoded chunks of
+        self.chunkRows rows as soon as they are ready.
+        """
+        buf = StringIO()
+        csv_writer = csv.writer(buf)
+
+        def flush():
+            data = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return data.encode('utf8')
+
+        for row in exportDescription:
+            csv_writer.writerow(row)
+
+        csv_writer.writerow([str(v) for v in header])
+        yield flush()
+
+        rows = 0
+        for row in self.serializeRows(querySet):
+            csv_writer.writerow([str(v) for v in row])
+            rows += 1
+            if rows % self.chunkRows == 0:
+                yield flush()
+
+        data = flush()
+        if data:
+            yield data
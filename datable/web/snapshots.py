@@ -0,0 +1,195 @@
+"""Snapshots of the ordered primary keys of filtered rows.
+
+A grid scrolling through a heavily filtered table asks for window after
+window of the same filters and sort, and the database runs the same
+WHERE and ORDER BY for each of them. In snapshot mode (see
+Storage.snapshotTimeout), the first request runs the query once and keeps
+the ordered primary keys, as an array of 64-bit integers (8 bytes per
+row). Later windows are sliced from the snapshot and only their rows are
+loaded, by primary key; the row count is the length of the snapshot.
+
+While scrolling, users see the rows as they were ordered when the
+snapshot was taken (rows deleted since are skipped), until it expires or
+the storage's cache is invalidated.
+
+Snapshots are kept in a Django cache (CacheSnapshots) or, for big ones,
+in files of a local directory (FileSnapshots), from which only the
+requested window is read. Only integer primary keys are supported.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from array import array
+
+logger = logging.getLogger(__name__)
+
+TYPECODE = 'q'
+
+# Returned by load for snapshots, which were too big to be kept
+TOO_BIG = 'too big'
+
+# Primary key fields, which can be kept in snapshots
+INTEGER_FIELDS = ('AutoField', 'BigAutoField', 'SmallAutoField',
+                  'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+                  'PositiveIntegerField', 'PositiveSmallIntegerField',
+                  'PositiveBigIntegerField')
+
+
+def makeKeys(pks):
+    """An array of primary keys, or None if they are not integers (or do
+    not fit in 64 bits)."""
+    try:
+        return array(TYPECODE, pks)
+    except (TypeError, OverflowError):
+        return None
+
+
+def getWindow(keys, start, count):
+    end = None
+    if count is not None:
+        end = start + count
+    return keys[start:end].tolist()
+
+
+class CacheSnapshots:
+    """I keep snapshots in a Django cache. Some cache backends limit the
+    size of values (1 MB in memcached by default) and silently drop
+    bigger ones, so snapshots over maxBytes (125000 rows by default) are
+    not cached: a warning is logged and a TOO_BIG marker is cached
+    instead, so the snapshot is not taken again until it expires. Use
+    FileSnapshots for bigger tables.
+    """
+
+    maxBytes = 1000000
+
+    def __init__(self, backend, timeout, maxBytes=None):
+        self.backend = backend
+        self.timeout = timeout
+
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+
+    def getMaxRows(self):
+        """Number of primary keys a snapshot can have, or None."""
+        if self.maxBytes is None:
+            return None
+        return self.maxBytes // array(TYPECODE).itemsize
+
+    def load(self, key, start, count):
+        """Primary keys of the window and the length of the snapshot,
+        None if there is no such snapshot or TOO_BIG."""
+        data = self.backend.get(key)
+        if data is None or data == TOO_BIG:
+            return data
+
+        keys = array(TYPECODE)
+        keys.frombytes(data)
+        return getWindow(keys, start, count), len(keys)
+
+    def save(self, key, keys):
+        """Returns False, if the snapshot is too big to be kept."""
+        maxRows = self.getMaxRows()
+        if maxRows is not None and len(keys) > maxRows:
+            logger.warning(
+                "Snapshot %s of over %i rows is too big for the cache; set "
+                "Storage.snapshotDirectory to keep it in a file",
+                key, maxRows)
+            self.backend.set(key, TOO_BIG, self.timeout)
+            return False
+
+        self.backend.set(key, keys.tobytes(), self.timeout)
+        return True
+
+
+_purgeLock = threading.Lock()
+_purged = {}
+
+
+class FileSnapshots:
+    """I keep snapshots in files of a directory. Only the requested
+    window is read from a file. Expired files are removed by save, at
+    most once per timeout.
+    """
+
+    suffix = '.pks'
+
+    def __init__(self, directory, timeout):
+        self.directory = directory
+        self.timeout = timeout
+
+    def getPath(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + self.suffix)
+
+    def getMaxRows(self):
+        return None
+
+    def isExpired(self, mtime, now=None):
+        if now is None:
+            now = time.time()
+        return now - mtime > self.timeout
+
+    def load(self, key, start, count):
+        try:
+            f = open(self.getPath(key), 'rb')
+        except (IOError, OSError):
+            return None
+
+        with f:
+            stat = os.fstat(f.fileno())
+            if self.isExpired(stat.st_mtime):
+                return None
+
+            keys = array(TYPECODE)
+            total = stat.st_size // keys.itemsize
+            if count is None:
+                count = total
+
+            f.seek(min(start, total) * keys.itemsize)
+            keys.frombytes(f.read(max(count, 0) * keys.itemsize))
+            return keys.tolist(), total
+
+    def save(self, key, keys):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Written to a temporary file first, so a snapshot is never read
+        # partially
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                keys.tofile(f)
+            os.replace(tmp, self.getPath(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self.purgeSometimes()
+        return True
+
+    def purgeSometimes(self):
+        now = time.time()
+        with _purgeLock:
+            if not self.isExpired(_purged.get(self.directory, 0), now):
+                return
+            _purged[self.directory] = now
+        self.purge()
+
+    def purge(self):
+        """Remove expired snapshot files."""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                if self.isExpired(os.path.getmtime(path), now):
+                    os.unlink(path)
+            except OSError:
+                # Removed by another process
+                pass
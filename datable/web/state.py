@@ -0,0 +1,125 @@
+"""State of a single request to a Storage.
+
+A FilterState is built once per request, from the request's QueryDict.
+It holds the converted widget values, the sort column and the requested
+window of rows, so converters do not parse the same values over and over.
+It can not be changed once built, and has stable keys, which may be used
+to build cache keys.
+"""
+
+import hashlib
+import json
+
+from datable.web.pagination import encodeValue
+
+
+def encodeStateValue(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [encodeStateValue(x) for x in value]
+    try:
+        return encodeValue(value)
+    except TypeError:
+        return ['repr', repr(value)]
+
+
+def makeHash(data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def parseWindow(valueDict):
+    """Returns start and count of the requested rows."""
+    try:
+        start = max(int(valueDict.get('start', 0)), 0)
+    except (TypeError, ValueError):
+        start = 0
+    try:
+        count = int(valueDict.get('count', 0)) or None
+    except (TypeError, ValueError):
+        count = None
+    return start, count
+
+
+class FilterState(object):
+    """Widget values, sort and window of a request; see fromRequest.
+
+    values is a tuple of (widget name, value) pairs, in the order of the
+    widgets; sort is a tuple of (column, desc) or None.
+    """
+
+    __slots__ = ('values', 'sort', 'start', 'count', 'cursor', 'syncToken',
+                 '_valueDict', 'filterKey', 'key')
+
+    def __init__(self, values=(), sort=None, start=0, count=None,
+                 cursor=None, syncToken=None):
+        init = object.__setattr__
+        init(self, 'values', tuple(values))
+        init(self, 'sort', sort)
+        init(self, 'start', start)
+        init(self, 'count', count)
+        init(self, 'cursor', cursor)
+        init(self, 'syncToken', syncToken)
+        init(self, '_valueDict', dict(self.values))
+
+        # Keys are computed once: widget values only, and everything
+        # which changes the returned rows (the cursor and the sync token
+        # do not)
+        filterKey = makeHash([[name, encodeStateValue(value)]
+                              for name, value in self.values])
+        init(self, 'filterKey', filterKey)
+        init(self, 'key', makeHash(
+            [filterKey, self.getSortKey(), self.start, self.count]))
+
+    @classmethod
+    def fromRequest(klass, storage, requestDict, order_by=None):
+        """Convert values of storage's widgets found in requestDict.
+        Without order_by, storage's default sort is used."""
+        values = []
+        for widget in storage.getWidgets():
+            if widget.existsIn(requestDict):
+                values.append(
+                    (widget.getName(), widget.getValue(requestDict)))
+
+        if not order_by:
+            order_by = storage.defaultSort
+
+        start, count = parseWindow(requestDict)
+        return klass(values, order_by or None, start, count,
+                     requestDict.get('cursor'), requestDict.get('sync'))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FilterState can not be changed")
+
+    def __contains__(self, name):
+        return name in self._valueDict
+
+    def __getitem__(self, name):
+        return self._valueDict[name]
+
+    def get(self, name, default=None):
+        return self._valueDict.get(name, default)
+
+    def getSortKey(self):
+        """Sort as a tuple of (column name, desc), or None."""
+        if not self.sort:
+            return None
+        return self.sort[0].getName(), bool(self.sort[1])
+
+    def __eq__(self, other):
+        if not isinstance(other, FilterState):
+            return NotImplemented
+        return self.key == other.key
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return '<FilterState %s>' % self.key
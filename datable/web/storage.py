@@ -1,19 +1,84 @@
+import hashlib
 import json
+import logging
+import re
+import shutil
 
 from datetime import datetime
 from urllib.parse import urlencode
 
 from datable import core
+from datable.core import formats
 
 from datable.core.serializers import PrimaryKeySerializer
+from datable.core.serializers import getSelectRelated
+from datable.core.serializers import getPrefetchRelated
+from datable.core.serializers import getRequiredFields
 
 from datable.web.serializers import JSONQuerySetSerializer
 from datable.web.serializers import CSVQuerySetSerializer
 from datable.web.serializers import XLSQuerySetSerializer
+from datable.web.serializers import XLSXQuerySetSerializer
+from datable.web import aio
+from datable.web import cache
+from datable.web import dbformat
+from datable.web import parallel
+from datable.web import push
+from datable.web import snapshots
+from datable.web.util import ChunkedIterator
+from datable.web.util import ITERATOR_PREFETCHES
+from datable.web.util import getRelatedModel
+from datable.web.util import getRelatedModels
+from datable.web.util import prefetchInChunks
+from datable.web.util import resolveFieldPath
+from datable.web.pagination import Cursor
+from datable.web.pagination import fetchByPrimaryKeys
+from datable.web.pagination import getAttribute
+from datable.web.pagination import getOrdering
+from datable.web.pagination import getSeekField
+from datable.web.pagination import orderForSeek
+from datable.web.pagination import seek
+from datable.web.state import FilterState
+from datable.web.state import makeHash
 
+from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+from django.db.models import Count
+from django.db.models import Max
+from django.utils.translation import get_language
 from django.utils.translation import ugettext as _
 from django.utils.safestring import mark_safe
 
+logger = logging.getLogger(__name__)
+
+syncTokenFormat = re.compile('^[0-9a-f]{40}$')
+
+
+def describeSerializer(value, depth=3):
+    """A description of a serializer and its settings, which is the same
+    in every process: functions and classes are described by name."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    if isinstance(value, (list, tuple)):
+        return [describeSerializer(item, depth) for item in value]
+
+    name = getattr(value, '__qualname__', None) or \
+        getattr(value, '__name__', None)
+    if name is not None:
+        return '%s.%s' % (getattr(value, '__module__', None), name)
+
+    klass = type(value)
+    result = ['%s.%s' % (klass.__module__, klass.__name__)]
+    if depth and hasattr(value, '__dict__'):
+        for key, item in sorted(vars(value).items()):
+            result.append([key, describeSerializer(item, depth - 1)])
+    return result
+
 class Storage:
     """I can filter a querySet using widgets;
     I can serialize it to various formats.
@@ -21,9 +86,39 @@ class Storage:
 
     primaryKeySerializer = None
     defaultSort = None
+    chunkSize = 2000  # rows fetched per database round-trip when exporting
+    planRelated = True  # join/prefetch relations used by serializers
+    projectFields = True  # load only fields used by serializers
+    keysetPagination = False  # seek past the previous page instead of OFFSET
+    deferredJoin = False  # page through primary keys, then load whole rows
+    cacheName = None  # prefix of cache keys; Table sets it (see getCacheName)
+    cacheBackend = None  # Django cache to use; None means the default one
+    countCacheTimeout = None  # seconds to cache row counts for
+    countCap = None  # stop counting rows after this many
+    concurrentCount = False  # count rows in another thread, while paging
+    concurrentTimeout = None  # seconds to wait for the concurrent count
+    databaseFormatting = False  # format plain columns in the database
+    pageCacheTimeout = None  # seconds to cache whole JSON pages for
+    cacheModels = ()  # more models, whose changes invalidate cached data
+    versionField = None  # changes whenever a row changes, like auto_now
+    rowCacheTimeout = None  # seconds to cache serialized rows for
+    deltaTimeout = None  # seconds to remember pages for delta refreshes
+    pushEvents = False  # stream change events to grids (datable.web.push)
+    snapshotTimeout = None  # seconds to keep ordered primary keys for
+    snapshotDirectory = None  # keep them in files there, not in the cache
+    frozen = False  # set by freeze()
+    watching = False  # set by watchModels()
 
     def __init__(self, querySet, columns, widgets=None, title='Sheet',
-                 primaryKeySerializer=None, defaultSort=None):
+                 primaryKeySerializer=None, defaultSort=None,
+                 chunkSize=None, planRelated=None, projectFields=None,
+                 keysetPagination=None, deferredJoin=None, cacheName=None,
+                 cacheBackend=None, countCacheTimeout=None, countCap=None,
+                 concurrentCount=None, concurrentTimeout=None,
+                 databaseFormatting=None, pageCacheTimeout=None,
+                 cacheModels=None, versionField=None, rowCacheTimeout=None,
+                 deltaTimeout=None, pushEvents=None, snapshotTimeout=None,
+                 snapshotDirectory=None):
         self.querySet = querySet
 
         self.columns = columns
@@ -51,24 +146,290 @@ class Storage:
             if col:
                 self.defaultSort = col, desc
 
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+
+        if planRelated is not None:
+            self.planRelated = planRelated
+
+        if projectFields is not None:
+            self.projectFields = projectFields
+
+        if keysetPagination is not None:
+            self.keysetPagination = keysetPagination
+
+        if deferredJoin is not None:
+            self.deferredJoin = deferredJoin
+
+        if cacheName is not None:
+            self.cacheName = cacheName
+
+        if cacheBackend is not None:
+            self.cacheBackend = cacheBackend
+
+        if countCacheTimeout is not None:
+            self.countCacheTimeout = countCacheTimeout
+
+        if countCap is not None:
+            self.countCap = countCap
+
+        if concurrentCount is not None:
+            self.concurrentCount = concurrentCount
+
+        if concurrentTimeout is not None:
+            self.concurrentTimeout = concurrentTimeout
+
+        if databaseFormatting is not None:
+            self.databaseFormatting = databaseFormatting
+
+        if pageCacheTimeout is not None:
+            self.pageCacheTimeout = pageCacheTimeout
+
+        if cacheModels is not None:
+            self.cacheModels = cacheModels
+
+        if versionField is not None:
+            self.versionField = versionField
+
+        if rowCacheTimeout is not None:
+            self.rowCacheTimeout = rowCacheTimeout
+
+        if deltaTimeout is not None:
+            self.deltaTimeout = deltaTimeout
+
+        if pushEvents is not None:
+            self.pushEvents = pushEvents
+
+        if snapshotTimeout is not None:
+            self.snapshotTimeout = snapshotTimeout
+
+        if snapshotDirectory is not None:
+            self.snapshotDirectory = snapshotDirectory
+
+    def __repr__(self):
+        return '<Storage %s>' % self.cacheName
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError("%s is frozen, it can not be changed" % self)
+        self.__dict__[name] = value
+
+    def validate(self):
+        """Check the definition of this storage; raises ImproperlyConfigured
+        on errors."""
+        if self.querySet is None:
+            raise ImproperlyConfigured("%s: no querySet" % self.title)
+
+        for column in self.columns:
+            if column.sortable and column.sortColumnName is None:
+                raise ImproperlyConfigured(
+                    "%s: column %s is sortable, but has no sortColumnName" % (
+                        self.title, column.getName()))
+
+        if self.versionField is not None and self.versionField != 'pk' and \
+           resolveFieldPath(self.querySet.model, self.versionField) is None:
+            raise ImproperlyConfigured(
+                "%s: versionField %s is not a field" % (
+                    self.title, self.versionField))
+
+        if self.snapshotTimeout and \
+           self.querySet.model._meta.pk.get_internal_type() not in \
+           snapshots.INTEGER_FIELDS:
+            raise ImproperlyConfigured(
+                "%s: snapshots need an integer primary key" % self.title)
+
+        if self.defaultSort and self.defaultSort[0] not in self.columns:
+            raise ImproperlyConfigured(
+                "%s: defaultSort is not one of the columns" % self.title)
+
+        for widget in self.widgets:
+            if widget.converter is None or widget.filter is None:
+                raise ImproperlyConfigured(
+                    "%s: widget %s has no converter or filter" % (
+                        self.title, widget.getName()))
+
+            other_storage = widget.getStorage()
+            if other_storage is not None:
+                other_storage.validate()
+
+    def freeze(self):
+        """Validate this storage and make it immutable, so it can be shared
+        by threads serving requests (see datable.web.registry). Lookups
+        of columns and widgets by name use indexes from now on."""
+        if self.frozen:
+            return
+
+        self.validate()
+
+        self.columns = tuple(self.columns)
+        self.widgets = tuple(self.widgets)
+
+        # the first one wins, as with a linear scan
+        self.columnIndex = {}
+        for no, column in enumerate(self.columns):
+            self.columnIndex.setdefault(column.getName(), no)
+
+        self.widgetIndex = {}
+        for widget in self.widgets:
+            self.widgetIndex.setdefault(widget.getName(), widget)
+
+        for widget in self.widgets:
+            other_storage = widget.getStorage()
+            if other_storage is not None:
+                other_storage.freeze()
+
+        # Cached data, validators and probes depend on the generation
+        if self.cacheName is not None:
+            self.watchModels()
+
+        self.frozen = True
+
+    def setDefaultCacheName(self, cacheName):
+        """Use cacheName, unless this storage has a name already; Table
+        calls it with its getCacheName(). Storages of widgets are named
+        after it. Frozen storages are shared, so they are not renamed."""
+        if self.frozen:
+            return
+
+        if self.cacheName is None:
+            self.cacheName = cacheName
 
-    def filterAndSort(self, valueDict, order_by):
-        querySet = self.querySet
         for widget in self.widgets:
-            querySet = widget.filterQuerySet(querySet, valueDict)
+            other_storage = widget.getStorage()
+            if other_storage is not None:
+                other_storage.setDefaultCacheName(
+                    '%s,widget,%s' % (cacheName, widget.getName()))
+
+    def getFilterState(self, valueDict, order_by=None):
+        """Parse a request's values once, to a FilterState. valueDict may
+        already be a FilterState; then it is returned as it is, and its
+        sort is used instead of order_by.
+
+        All methods of Storage taking a valueDict accept a FilterState, too.
+        """
+        if isinstance(valueDict, FilterState):
+            return valueDict
+        return FilterState.fromRequest(self, valueDict, order_by)
+
+    def filterAndSort(self, valueDict, order_by=None):
+        state = self.getFilterState(valueDict, order_by)
+        querySet = self.filterQuerySet(state)
+        return self.optimizeQuerySet(querySet, state.sort)
 
-        if not order_by:
-            order_by = self.defaultSort
+    def filterQuerySet(self, valueDict, order_by=None):
+        """Filter and sort the querySet, without any of the optimizations
+        for loading and serializing whole rows."""
+        state = self.getFilterState(valueDict, order_by)
 
+        # A clone: the querySet may be shared by many threads
+        querySet = self.querySet.all()
+        for widget in self.widgets:
+            querySet = widget.filterQuerySet(querySet, state)
+
+        order_by = state.sort
         if order_by:
             querySet = order_by[0].sortQuerySet(querySet, order_by[1])
 
         return querySet
 
+    def optimizeQuerySet(self, querySet, order_by):
+        querySet = self.planQuerySet(querySet)
+        return self.projectQuerySet(querySet, order_by)
+
+    def getRelatedPlan(self):
+        """Relations read by serializers of this storage's columns, as
+        a tuple of (select_related, prefetch_related) field lists.
+        """
+        select = []
+        prefetch = []
+
+        for serializer in self.getSerializers():
+            for lst, names in [(select, getSelectRelated(serializer)),
+                               (prefetch, getPrefetchRelated(serializer))]:
+                for name in names:
+                    if name not in lst:
+                        lst.append(name)
+
+        # 'a' is already joined, when 'a__b' is
+        select = [name for name in select
+                  if not [other for other in select
+                          if other.startswith(name + "__")]]
+
+        return select, prefetch
+
+    def planQuerySet(self, querySet):
+        """Apply the related plan to querySet, so serializing a row
+        does not cost any extra queries."""
+        if not self.planRelated:
+            return querySet
+
+        select, prefetch = self.getRelatedPlan()
+        if select:
+            querySet = querySet.select_related(*select)
+        if prefetch:
+            querySet = querySet.prefetch_related(*prefetch)
+        return querySet
+
+    def getRequiredFields(self, order_by=None):
+        """Names of model fields read by this storage's serializers and
+        by the sort column, or None if any serializer does not tell.
+        """
+        fields = []
+
+        for serializer in self.getSerializers() + [self.primaryKeySerializer]:
+            names = getRequiredFields(serializer)
+            if names is None:
+                return None
+            fields.extend(names)
+
+        if order_by:
+            fields.append(order_by[0].sortColumnName)
+
+        if self.versionField:
+            fields.append(self.versionField)
+
+        result = []
+        for name in fields:
+            if name == 'pk' or name.endswith('__pk') or name in result:
+                continue
+            result.append(name)
+        return result
+
+    def projectQuerySet(self, querySet, order_by=None):
+        """Defer loading of model fields, which no serializer reads.
+        If the fields are not known, the full rows are loaded."""
+        if not self.projectFields:
+            return querySet
+
+        fields = self.getRequiredFields(order_by)
+        if fields is None:
+            return querySet
+
+        select = []
+        if self.planRelated:
+            select = self.getRelatedPlan()[0]
+
+        for name in fields:
+            if resolveFieldPath(querySet.model, name) is None:
+                return querySet
+
+            if '__' in name:
+                # Related fields can only be loaded using select_related
+                prefix = name.rsplit('__', 1)[0]
+                if not [other for other in select
+                        if other == prefix or
+                        other.startswith(prefix + '__')]:
+                    return querySet
+
+        return querySet.only(*fields)
+
     def getWidgets(self):
         return self.widgets
 
     def getWidget(self, name):
+        if self.frozen:
+            return self.widgetIndex.get(name)
+
         for widget in self.widgets:
             if widget.getName() == name:
                 return widget
@@ -83,6 +444,9 @@ class Storage:
         return self.columns[idx]
 
     def getColumnIndex(self, name):
+        if self.frozen:
+            return self.columnIndex.get(name)
+
         for no, column in enumerate(self.columns):
             if column.getName() == name:
                 return no
@@ -91,7 +455,7 @@ class Storage:
         return [c.getSerializer() for c in self.columns]
 
     def getHeader(self):
-        return [c.getLabel() for c in self.columns]
+        return [str(c.getLabel()) for c in self.columns]
 
     def describeExportData(self, valueDict):
         """Few rows of description for an export file - when was the file
@@ -100,52 +464,921 @@ class Storage:
 
         yield _("Exported on"), datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        state = self.getFilterState(valueDict)
         for w in self.widgets:
-            d = w.exportDescription(valueDict)
+            d = w.exportDescription(state)
             if d is not None:
                 yield d
 
-    def serializeToJSON(self, valueDict, order_by):
-        querySet = self.filterAndSort(valueDict, order_by)
-        start = int(valueDict.get('start', 0))
+    def iterateForExport(self, querySet, progress=None):
+        """Yield models of querySet, chunkSize at a time, so the memory
+        used by an export does not depend on the size of the result.
+        progress is called with the number of rows fetched so far, once
+        per chunk and at the end."""
+        rows = models = ChunkedIterator(querySet, self.chunkSize)
+
+        if self.planRelated and not ITERATOR_PREFETCHES:
+            # Otherwise every M2M column would cost a query per row
+            prefetch = self.getRelatedPlan()[1]
+            if prefetch:
+                models = prefetchInChunks(rows, prefetch, self.chunkSize)
+
+        for model in models:
+            yield model
+            if progress is not None and rows.rows % self.chunkSize == 0:
+                progress(rows.rows)
+
+        if progress is not None:
+            progress(rows.rows)
+        self.exportFinished(rows)
+
+    def exportFinished(self, rows):
+        """Called with a ChunkedIterator when an export has fetched
+        all of its rows."""
+        logger.info("%s: exported %i rows in %i chunks",
+                    self.title, rows.rows, rows.chunks)
+
+    def serializeToJSON(self, valueDict, order_by=None, counted=None):
+        """A JSON page. counted is the row count as returned by getCount,
+        if the caller has it already (see getValidator)."""
+        state = self.getFilterState(valueDict, order_by)
+
+        if self.useDelta():
+            snapshot = self.loadSnapshot(state)
+            if snapshot is not None:
+                return self.serializeDelta(state, snapshot)
+
+        key = self.getPageKey(state)
+        if key is not None:
+            data = self.getCachedPage(key)
+            if data is not None:
+                return data
+
+        data = self.buildJSON(state, counted)
+
+        if key is not None:
+            self.getCache().set(key, data, self.pageCacheTimeout)
+        return data
+
+    def buildJSON(self, state, counted=None):
+        """serializeToJSON, without the page cache."""
+        order_by = state.sort
+
+        querySet = self.filterQuerySet(state)
+        start, count = state.start, state.count
+
+        # Taken before the page, so no change is ever missed
+        snapshot = None
+        if self.useDelta():
+            snapshot = self.getSnapshot(querySet, start, count)
+
+        window = None
+        if self.useKeySnapshots():
+            window = self.getKeyWindow(querySet, state)
+
+        if window is not None:
+            data = self.serializeKeyWindow(state, querySet, window)
+            if snapshot is not None:
+                data['syncToken'] = self.saveSnapshot(state, snapshot)
+            return data
+
+        cells = self.useRowCache()
+
+        plan = None
+        if not self.keysetPagination and not cells:
+            plan = self.getDatabasePlan(querySet)
+
+        if cells:
+            fetchPage, args = self.fetchCachedPage, (querySet, order_by)
+        elif plan is not None:
+            fetchPage, args = self.fetchValuesPage, (plan, querySet)
+        else:
+            fetchPage, args = self.fetchPage, (querySet, state, order_by)
+
+        if counted is not None:
+            totalRows, capped = counted
+            page, cursor = fetchPage(*(args + (start, count)))
+        elif self.concurrentCount:
+            (totalRows, capped), (page, cursor) = parallel.callWith(
+                parallel.submit(self.getCount, querySet, state),
+                fetchPage, *(args + (start, count)),
+                timeout=self.concurrentTimeout)
+        else:
+            totalRows, capped = self.getCount(querySet, state)
+            page, cursor = fetchPage(*(args + (start, count)))
+
+        if capped:
+            totalRows, capped = self.extendCappedCount(
+                totalRows, state, len(page))
+
+        data = self.serializePage(page, totalRows, cursor, plan, cells)
+        if capped:
+            data['numRowsCapped'] = True
+
+        if snapshot is not None:
+            data['syncToken'] = self.saveSnapshot(state, snapshot)
+        return data
+
+    def getDatabasePlan(self, querySet):
+        """With databaseFormatting, a DatabasePlan for this storage's
+        columns, if all of them can be handled by the database."""
+        if not self.databaseFormatting:
+            return None
+        return dbformat.compilePlan(self.getSerializers(), querySet)
+
+    def fetchValuesPage(self, plan, querySet, start, count):
+        """fetchPage for a DatabasePlan: rows are tuples of values."""
+        end = None
+        if count is not None:
+            end = start + count
+        return list(plan.valuesList(querySet)[start:end]), None
+
+    async def aserializeToJSON(self, valueDict, order_by=None, counted=None):
+        """serializeToJSON for asyncio: counts and pages using the async
+        ORM when possible."""
+        state = self.getFilterState(valueDict, order_by)
+
+        if self.useDelta():
+            snapshot = await aio.runSync(self.loadSnapshot, state)
+            if snapshot is not None:
+                return await aio.runSync(
+                    self.serializeDelta, state, snapshot)
+
+        key = await aio.runSync(self.getPageKey, state)
+        if key is not None:
+            data = await aio.runSync(self.getCachedPage, key)
+            if data is not None:
+                return data
+
+        data = await self.abuildJSON(state, counted)
+
+        if key is not None:
+            await aio.runSync(
+                self.getCache().set, key, data, self.pageCacheTimeout)
+        return data
+
+    async def abuildJSON(self, state, counted=None):
+        order_by = state.sort
+
+        querySet = self.filterQuerySet(state)
+        start, count = state.start, state.count
+
+        snapshot = None
+        if self.useDelta():
+            snapshot = await aio.runSync(
+                self.getSnapshot, querySet, start, count)
+
+        if self.useKeySnapshots():
+            window = await aio.runSync(self.getKeyWindow, querySet, state)
+            if window is not None:
+                data = await aio.runSync(
+                    self.serializeKeyWindow, state, querySet, window)
+                if snapshot is not None:
+                    data['syncToken'] = await aio.runSync(
+                        self.saveSnapshot, state, snapshot)
+                return data
+
+        if counted is not None:
+            totalRows, capped = counted
+        elif self.countCacheTimeout or self.countCap:
+            totalRows, capped = await aio.runSync(
+                self.getCount, querySet, state)
+        else:
+            totalRows, capped = await aio.acount(querySet), False
+
+        cells = self.useRowCache()
+
+        plan = None
+        if not self.keysetPagination and not cells:
+            plan = await aio.runSync(self.getDatabasePlan, querySet)
+
+        if cells:
+            page, cursor = await aio.runSync(
+                self.fetchCachedPage, querySet, order_by, start, count)
+        elif plan is not None:
+            end = None
+            if count is not None:
+                end = start + count
+            page = await aio.alist(plan.valuesList(querySet)[start:end])
+            cursor = None
+        elif self.keysetPagination or self.deferredJoin or \
+                self.getRelatedPlan()[1]:
+            # prefetch_related and multi-step fetches: not async-capable
+            page, cursor = await aio.runSync(
+                self.fetchPage, querySet, state, order_by, start, count)
+        else:
+            page = await aio.alist(
+                self.getPage(querySet, order_by, start, count))
+            cursor = None
+
+        if capped:
+            totalRows, capped = self.extendCappedCount(
+                totalRows, state, len(page))
+
+        # Custom serializers may still query the database
+        data = await aio.runSync(
+            self.serializePage, page, totalRows, cursor, plan, cells)
+        if capped:
+            data['numRowsCapped'] = True
+
+        if snapshot is not None:
+            data['syncToken'] = await aio.runSync(
+                self.saveSnapshot, state, snapshot)
+        return data
+
+    def getWindow(self, valueDict):
+        """Returns start and count of the requested rows."""
+        state = self.getFilterState(valueDict)
+        return state.start, state.count
+
+    def serializePage(self, page, totalRows, cursor=None,
+                      databasePlan=None, cells=False):
+        """Serialize a page of models (or of tuples from databasePlan).
+        With cells, page is a list of (pk, serialized row) pairs."""
+        serializer = JSONQuerySetSerializer(
+            columns=self.getColumns(),
+            databasePlan=databasePlan)
+
+        if cells:
+            data = serializer.serializeCells(page, totalRows)
+        else:
+            data = serializer.serialize(page, totalRows)
+
+        if self.keysetPagination:
+            data['cursor'] = cursor
+
+        return data
+
+    def extendCappedCount(self, totalRows, state, rows):
+        """The row count reported to the grid, when counting stopped at
+        countCap (see getCount), and whether it is still a lower bound.
+        It reaches a page past the rows fetched, so the grid can scroll
+        on, until a page comes back short; then the count is known.
+        """
+        if state.count is None or rows < state.count:
+            return state.start + rows, False
+        return max(totalRows, state.start + rows + state.count), True
+
+    def getCache(self):
+        if self.cacheBackend is not None:
+            return self.cacheBackend
+        return cache.defaultCache
+
+    def getGeneration(self):
+        return cache.getGeneration(self.cacheName, self.getCache())
+
+    def invalidateCache(self):
+        """Make all cached data of this storage stale; call it when
+        the data changes."""
+        if self.cacheName is not None:
+            cache.invalidate(self.cacheName, self.getCache())
+
+    def getQueryKey(self):
+        """A hash of the querySet's SQL. Storages built for a request may
+        have querySets depending on it (like rows of request.user), so it
+        is a part of keys of cached data, which is never shared by them.
+        """
+        if self.querySet is None:
+            return None
+
         try:
-            count = int(valueDict.get('count', 0)) or None
-        except (TypeError, ValueError):
-            count = None
+            sql, params = self.querySet.query.sql_with_params()
+        except EmptyResultSet:
+            return None
+        return makeHash([sql, [repr(param) for param in params]])
+
+    def getPageKey(self, state):
+        """Cache key of a JSON page, or None if pages are not cached.
+        The key changes with the querySet, the filters, the sort and the
+        window, and when the storage's data changes (see watchModels)."""
+        if not self.pageCacheTimeout or self.cacheName is None:
+            return None
+
+        if not self.watching:
+            self.watchModels()
+
+        return cache.makeKey(
+            'page', self.cacheName, self.getGeneration(), get_language(),
+            self.getQueryKey(), state.key)
+
+    def getCachedPage(self, key):
+        data = self.getCache().get(key)
+        if data is None:
+            cache.record(self.cacheName, 'misses')
+        else:
+            cache.record(self.cacheName, 'hits')
+        return data
+
+    def getCacheStats(self):
+        """Hits and misses of the page cache, as a dict."""
+        return cache.getStats(self.cacheName)
+
+    def getWatchedModels(self):
+        """Models, whose changes invalidate cached data of this storage:
+        the querySet's model, models of relations read by serializers
+        and cacheModels."""
+        model = self.querySet.model
+        result = [model]
+
+        select, prefetch = self.getRelatedPlan()
+        paths = select + prefetch + (self.getRequiredFields() or [])
+        for path in paths:
+            for other in getRelatedModels(model, path):
+                if other not in result:
+                    result.append(other)
+
+        for other in self.cacheModels:
+            if other not in result:
+                result.append(other)
+
+        return result
+
+    def watchModels(self):
+        """Invalidate cached data of this storage whenever one of
+        getWatchedModels() is saved or deleted."""
+        cache.watchModels(
+            self.cacheName, self.getWatchedModels(), self.cacheBackend)
+        self.watching = True
+
+    def useRowCache(self):
+        """Are serialized rows cached? Not with keyset pagination, which
+        needs whole models for its cursor."""
+        return bool(self.rowCacheTimeout and self.versionField and
+                    self.cacheName is not None and
+                    not self.keysetPagination)
+
+    def getLayoutKey(self):
+        """A hash of the columns' names and serializers, so tables of a
+        model with other columns never share serialized rows."""
+        return makeHash([
+            [column.getName(), describeSerializer(column.getSerializer())]
+            for column in self.getColumns()])
+
+    def getRowKeyPrefix(self):
+        """The part of row keys common to all rows: it changes with the
+        columns and when the storage's data (or related data) changes."""
+        return cache.makeKey(
+            'row', self.cacheName, self.getGeneration(), get_language(),
+            self.getLayoutKey())
+
+    def getRowKey(self, pk, version, prefix=None):
+        if prefix is None:
+            prefix = self.getRowKeyPrefix()
 
+        # Hashed: a version like a date-time has spaces and colons, which
+        # memcached does not accept in keys
+        return cache.makeKey(prefix, makeHash([str(pk), str(version)]))
+
+    def fetchCachedPage(self, querySet, order_by, start, count):
+        """fetchPage using the row cache. Primary keys and versions of the
+        page's rows are read first; whole rows are loaded and serialized
+        for those, which are not in the cache, only. Returns a list of
+        (pk, serialized row) pairs and no cursor.
+        """
         end = None
         if count is not None:
             end = start + count
-        totalRows = querySet.count()
 
-        return JSONQuerySetSerializer(
-            columns=self.getColumns()
-            ).serialize(querySet[start:end], totalRows)
+        versions = list(
+            querySet.values_list('pk', self.versionField)[start:end])
+        return self.fetchCachedRows(versions, order_by), None
+
+    def fetchCachedRows(self, versions, order_by):
+        """Serialized rows for a list of (pk, version) pairs, from the row
+        cache when possible."""
+        if not self.watching:
+            self.watchModels()
+
+        prefix = self.getRowKeyPrefix()
+        keys = [self.getRowKey(pk, version, prefix)
+                for pk, version in versions]
+
+        backend = self.getCache()
+        found = backend.get_many(keys)
+
+        cells = {}
+        missing = []
+        for (pk, version), key in zip(versions, keys):
+            if key in found:
+                cells[pk] = found[key]
+            else:
+                missing.append(pk)
+
+        cache.record(self.cacheName, 'rowHits', len(cells))
+        cache.record(self.cacheName, 'rowMisses', len(missing))
+
+        if missing:
+            models = self.getRowsByPrimaryKeys(missing, order_by)
+            rows = JSONQuerySetSerializer(
+                columns=self.getColumns()).serializeBatch(models)
+
+            new = {}
+            for model, row in zip(models, rows):
+                cells[model.pk] = row
+                version = getAttribute(model, self.versionField)
+                new[self.getRowKey(model.pk, version, prefix)] = row
+            backend.set_many(new, self.rowCacheTimeout)
+
+        # Rows deleted in the meantime are skipped
+        return [(pk, cells[pk]) for pk, version in versions
+                if pk in cells]
+
+    def useKeySnapshots(self):
+        """Are windows sliced from snapshots of the ordered primary keys
+        (see datable.web.snapshots)? Not with keyset pagination."""
+        return bool(self.snapshotTimeout and self.cacheName is not None and
+                    not self.keysetPagination)
+
+    def getKeySnapshots(self):
+        if self.snapshotDirectory is not None:
+            return snapshots.FileSnapshots(
+                self.snapshotDirectory, self.snapshotTimeout)
+        return snapshots.CacheSnapshots(self.getCache(), self.snapshotTimeout)
+
+    def getKeyWindow(self, querySet, state):
+        """Primary keys of the state's window and the count of all
+        filtered rows, from a snapshot of the filtered and sorted
+        querySet. The snapshot is taken, if there is none yet. Returns
+        None, if the primary keys are not integers or there are too many
+        of them to be kept.
+        """
+        if not self.watching:
+            self.watchModels()
+
+        key = cache.makeKey(
+            'snapshot', self.cacheName, self.getGeneration(),
+            self.getQueryKey(), state.filterKey,
+            makeHash(state.getSortKey()))
+        store = self.getKeySnapshots()
+
+        window = store.load(key, state.start, state.count)
+        if window == snapshots.TOO_BIG:
+            return None
+
+        if window is not None:
+            cache.record(self.cacheName, 'snapshotHits')
+            return window
+
+        cache.record(self.cacheName, 'snapshotMisses')
+        pks = querySet.values_list('pk', flat=True)
+
+        # One key more tells the snapshot is too big
+        maxRows = store.getMaxRows()
+        if maxRows is not None:
+            pks = pks[:maxRows + 1]
+
+        keys = snapshots.makeKeys(ChunkedIterator(pks, self.chunkSize))
+        if keys is None or not store.save(key, keys):
+            return None
+
+        return snapshots.getWindow(keys, state.start, state.count), len(keys)
+
+    def fetchByKeys(self, pks, order_by, plan=None, cells=False):
+        """fetchPage for primary keys of a window: models, tuples of a
+        DatabasePlan or (pk, serialized row) pairs, in the order of pks.
+        Rows deleted in the meantime are skipped."""
+        if cells:
+            versions = dict(self.querySet.filter(pk__in=pks).values_list(
+                'pk', self.versionField))
+            return self.fetchCachedRows(
+                [(pk, versions[pk]) for pk in pks if pk in versions],
+                order_by), None
+
+        if plan is not None:
+            rows = dict((row[0], row) for row in plan.valuesList(
+                self.querySet.filter(pk__in=pks)))
+            return [rows[pk] for pk in pks if pk in rows], None
+
+        return self.getRowsByPrimaryKeys(pks, order_by), None
+
+    def serializeKeyWindow(self, state, querySet, window):
+        """A JSON page for a window from getKeyWindow."""
+        cells = self.useRowCache()
+        plan = None
+        if not cells:
+            plan = self.getDatabasePlan(querySet)
+
+        pks, totalRows = window
+        page, cursor = self.fetchByKeys(pks, state.sort, plan, cells)
+        return self.serializePage(page, totalRows, None, plan, cells)
+
+    def getETag(self, valueDict, order_by=None):
+        """A cheap validator of the JSON page, computed without fetching
+        the page: the newest versionField value, the biggest primary key
+        and the row count of the filtered rows, with the filters, sort,
+        window, language and cache generation. None, if there is no
+        versionField.
+        """
+        return self.getValidator(valueDict, order_by)[0]
+
+    def getValidator(self, valueDict, order_by=None):
+        """getETag and the row count it was computed from, as returned by
+        getCount, or (None, None). Pass the count to serializeToJSON, so
+        the rows are not counted again.
+
+        Changes of related rows, which do not change versionField, are
+        noticed by the cache generation, so there is no ETag without a
+        cacheName."""
+        if not self.versionField or self.cacheName is None:
+            return None, None
+
+        if not self.watching:
+            self.watchModels()
+
+        state = self.getFilterState(valueDict, order_by)
+        maxPk, version, counted = self.aggregateVersion(state)
+        etag = self.makeValidator(
+            [state.key, get_language()], [maxPk, version, counted[0]])
+        return etag, counted
+
+    def getDataETag(self, valueDict, data):
+        """A validator of an already serialized JSON page."""
+        state = self.getFilterState(valueDict)
+        return self.makeValidator([state.key, get_language()], [data])
 
-    def serializeToCSV(self, valueDict, order_by):
-        querySet = self.filterAndSort(valueDict, order_by)
+    def aggregateVersion(self, state):
+        """The biggest primary key, the newest versionField value (if
+        there is a versionField) and the row count, as returned by
+        getCount, of the filtered rows. Rows are counted in the same
+        query, unless the count is capped or cached by getCount."""
+        querySet = self.filterQuerySet(state)
+
+        aggregates = dict(maxPk=Max('pk'))
+        if self.versionField:
+            aggregates['version'] = Max(self.versionField)
+
+        useGetCount = self.countCap or self.countCacheTimeout
+        if not useGetCount:
+            aggregates['count'] = Count('pk')
+
+        result = querySet.order_by().aggregate(**aggregates)
+        if useGetCount:
+            counted = self.getCount(querySet, state)
+        else:
+            counted = result['count'], False
+        return result['maxPk'], result.get('version'), counted
+
+    def makeValidator(self, key, parts):
+        generation = None
+        if self.cacheName is not None:
+            generation = self.getGeneration()
+
+        data = [self.cacheName, generation, self.getQueryKey()] + key + parts
+        return hashlib.sha1(json.dumps(
+            data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def probe(self, valueDict, order_by=None):
+        """Has anything changed? Returns the number of filtered rows and
+        a version, which changes with them, computed by aggregateVersion.
+        The sort and the window do not matter.
+
+        Updates, which do not change versionField (or of related rows),
+        are noticed by model signals (see watchModels), which need a
+        cacheName. Without one, the version is None: the grid can not tell
+        whether rows changed, so it reloads.
+        """
+        state = self.getFilterState(valueDict, order_by)
+
+        if self.cacheName is not None and not self.watching:
+            self.watchModels()
+
+        maxPk, version, (count, capped) = self.aggregateVersion(state)
+        result = {'version': None, 'numRows': count}
+        if self.cacheName is not None:
+            result['version'] = self.makeValidator(
+                [state.filterKey], [maxPk, version, count])
+        return result
+
+    def useDelta(self):
+        """Are delta refreshes possible? They need a versionField."""
+        return bool(self.deltaTimeout and self.versionField and
+                    self.cacheName is not None)
+
+    def getSnapshot(self, querySet, start, count):
+        """Primary keys and versions of rows in the window, in order."""
+        end = None
+        if count is not None:
+            end = start + count
+        return [tuple(row) for row in
+                querySet.values_list('pk', self.versionField)[start:end]]
+
+    def saveSnapshot(self, state, snapshot):
+        """Remember a window's snapshot; returns a sync token for it."""
+        token = self.makeValidator([state.key], snapshot)
+        self.getCache().set(
+            cache.makeKey('sync', self.cacheName, token),
+            (state.key, snapshot), self.deltaTimeout)
+        return token
+
+    def loadSnapshot(self, state):
+        """The snapshot of the state's sync token, or None if there is no
+        token, it expired or it was made for other filters, sort or
+        window."""
+        token = state.syncToken
+        if not token or not syncTokenFormat.match(token):
+            return None
+
+        value = self.getCache().get(
+            cache.makeKey('sync', self.cacheName, token))
+        if value is None or value[0] != state.key:
+            return None
+        return value[1]
+
+    def serializeDelta(self, state, snapshot):
+        """Compare the window with a snapshot sent earlier. Returns rows
+        inserted into the window and updated since then, primary keys of
+        inserted, updated and deleted rows, the current order of rows,
+        the row count and a new sync token.
+        """
+        querySet = self.filterQuerySet(state)
+        current = self.getSnapshot(querySet, state.start, state.count)
+
+        old = dict(snapshot)
+        new = dict(current)
+
+        inserted = [pk for pk, version in current if pk not in old]
+        deleted = [pk for pk, version in snapshot if pk not in new]
+        updated = [pk for pk, version in current
+                   if pk in old and old[pk] != version]
+
+        serializer = JSONQuerySetSerializer(columns=self.getColumns())
+        rows = []
+        if inserted or updated:
+            models = self.getRowsByPrimaryKeys(inserted + updated, state.sort)
+            rows = list(zip([model.pk for model in models],
+                            serializer.serializeBatch(models)))
+
+        totalRows, capped = self.getCount(querySet, state)
+        if capped:
+            totalRows, capped = self.extendCappedCount(
+                totalRows, state, len(current))
+
+        data = serializer.serializeCells(rows, totalRows)
+        if capped:
+            data['numRowsCapped'] = True
+        order = [pk for pk, version in current]
+        data.update(
+            delta=True,
+            inserted=inserted,
+            updated=updated,
+            deleted=deleted,
+            order=order,
+            moved=[pk for pk in order if pk in old] != [
+                pk for pk, version in snapshot if pk in new],
+            syncToken=self.saveSnapshot(state, current))
+
+        return data
+
+    def streamEvents(self, valueDict, order_by=None):
+        """Server-Sent Events telling a grid, that its rows changed; see
+        datable.web.push."""
+        return push.eventStream(self, self.getFilterState(valueDict, order_by))
+
+    def astreamEvents(self, valueDict, order_by=None):
+        return push.aeventStream(
+            self, self.getFilterState(valueDict, order_by))
+
+    def getCount(self, querySet, valueDict):
+        """Count rows of a filtered querySet. With countCap set, counting
+        stops after countCap rows. With countCacheTimeout set, the result is
+        cached for the filter values (not the sort or the window). Returns
+        a tuple of (count, capped).
+        """
+        key = None
+        if self.countCacheTimeout and self.cacheName is not None:
+            key = cache.makeKey(
+                'count', self.cacheName, self.getGeneration(),
+                self.getQueryKey(), self.getFilterKey(valueDict))
+            result = self.getCache().get(key)
+            if result is not None:
+                return result
+
+        if self.countCap:
+            totalRows = querySet[:self.countCap + 1].count()
+            result = min(totalRows, self.countCap), totalRows > self.countCap
+        else:
+            result = querySet.count(), False
+
+        if key is not None:
+            self.getCache().set(key, result, self.countCacheTimeout)
+
+        return result
+
+    def fetchPage(self, querySet, valueDict, order_by, start, count):
+        """Fetch rows of the page; returns a list of models and a keyset
+        pagination cursor (or None)."""
+        if self.keysetPagination:
+            return self.getKeysetPage(
+                querySet, valueDict, order_by, start, count)
+        return list(self.getPage(querySet, order_by, start, count)), None
+
+    def getPage(self, querySet, order_by, start, count):
+        """Rows of a filtered and sorted querySet, from start to
+        start + count. With deferredJoin, only the primary keys are read
+        using OFFSET, then whole rows are loaded for these keys only.
+        """
+        end = None
+        if count is not None:
+            end = start + count
+
+        if not self.deferredJoin:
+            return self.optimizeQuerySet(querySet, order_by)[start:end]
+
+        pks = list(querySet.values_list('pk', flat=True)[start:end])
+        return self.getRowsByPrimaryKeys(pks, order_by)
+
+    def getRowsByPrimaryKeys(self, pks, order_by):
+        """Load rows with given primary keys, in the same order."""
+        rows = self.optimizeQuerySet(self.querySet.order_by(), order_by)
+        return fetchByPrimaryKeys(rows, pks)
+
+    def getFilterKey(self, valueDict):
+        """A short, stable key describing values of all widgets found
+        in valueDict."""
+        return self.getFilterState(valueDict).filterKey
+
+    def getSeekOrder(self, querySet):
+        """The ordering used for keyset pagination: querySet's own
+        ordering (see getOrdering), so a page is the same as with OFFSET,
+        with the primary key as a tiebreaker. None, if it can not be used
+        to seek: it has expressions, relations or fields which may be NULL.
+        """
+        ordering = getOrdering(querySet)
+        if ordering is None:
+            return None
+
+        model = querySet.model
+        pkName = model._meta.pk.name
+        prefix = ''
+        order = []
+
+        for name in ordering:
+            field, desc = getSeekField(name)
+            prefix = ''
+            if desc:
+                prefix = '-'
+
+            if field in ('pk', pkName):
+                # Already total
+                order.append(prefix + 'pk')
+                return order
+
+            modelField = resolveFieldPath(model, field)
+            if modelField is None or modelField.null or \
+               getRelatedModel(modelField) is not None:
+                return None
+            order.append(name)
+
+        order.append(prefix + 'pk')
+        return order
+
+    def getKeysetPage(self, querySet, valueDict, order_by, start, count):
+        """Fetch a page of rows. If the client sent a cursor pointing at
+        the last row before `start`, seek past it; otherwise fall back to
+        OFFSET (for example, after a jump with the scrollbar). Returns
+        the page and a cursor for the next one.
+        """
+        order = self.getSeekOrder(querySet)
+        if order is None:
+            return list(self.getPage(querySet, order_by, start, count)), None
+
+        state = self.getFilterState(valueDict, order_by)
+        filterKey = state.filterKey
+        querySet = orderForSeek(querySet, order)
+
+        cursor = Cursor.decode(state.cursor)
+        if cursor is not None and cursor.matches(start, order, filterKey):
+            page = self.optimizeQuerySet(
+                seek(querySet, cursor), order_by)[:count]
+        else:
+            page = self.getPage(querySet, order_by, start, count)
+
+        page = list(page)
+        if not page:
+            return page, None
+
+        last = page[-1]
+        values = [getAttribute(last, getSeekField(name)[0])
+                  for name in order]
+        if [value for value in values if value is None]:
+            return page, None
+
+        next = Cursor(start + len(page), values, order, filterKey)
+        try:
+            return page, next.encode()
+        except TypeError:
+            # A value of a type cursors can not hold: the next page falls
+            # back to OFFSET
+            return page, None
+
+    def getExportQuerySet(self, state):
+        """The QuerySet to export and a DatabasePlan for it (or None).
+        """
+        querySet = self.filterQuerySet(state)
+
+        plan = self.getDatabasePlan(querySet)
+        if plan is not None:
+            return plan.valuesList(querySet), plan
+
+        return self.optimizeQuerySet(querySet, state.sort), None
+
+    def serializeToCSV(self, valueDict, order_by=None):
+        state = self.getFilterState(valueDict, order_by)
+        querySet, plan = self.getExportQuerySet(state)
 
         data = CSVQuerySetSerializer(
-            columns=self.getColumns()
+            columns=self.getColumns(),
+            databasePlan=plan
         ).serialize(
-            querySet,
+            self.iterateForExport(querySet),
             self.title,
             self.getHeader(),
-            self.describeExportData(valueDict)
+            self.describeExportData(state)
         )
         data.seek(0)
         return data
 
-    def serializeToXLS(self, valueDict, order_by):
-        querySet = self.filterAndSort(valueDict, order_by)
+    def streamToCSV(self, valueDict, order_by=None, progress=None):
+        """Like serializeToCSV, but returns an iterator of encoded
+        chunks instead of a file-like object."""
+        state = self.getFilterState(valueDict, order_by)
+        querySet, plan = self.getExportQuerySet(state)
+
+        return CSVQuerySetSerializer(
+            columns=self.getColumns(),
+            databasePlan=plan
+        ).stream(
+            self.iterateForExport(querySet, progress),
+            self.title,
+            self.getHeader(),
+            self.describeExportData(state)
+        )
+
+    def serializeToXLS(self, valueDict, order_by=None, progress=None):
+        state = self.getFilterState(valueDict, order_by)
+        querySet, plan = self.getExportQuerySet(state)
 
         data = XLSQuerySetSerializer(
-            columns=self.getColumns()
+            columns=self.getColumns(),
+            databasePlan=plan
         ).serialize(
-            querySet,
+            self.iterateForExport(querySet, progress),
             self.title,
             self.getHeader(),
-            self.describeExportData(valueDict)
+            self.describeExportData(state)
         )
         data.seek(0)
         return data
+
+    def streamToXLSX(self, valueDict, order_by=None, progress=None):
+        """Export to XLSX, as an iterator of chunks of the file."""
+        state = self.getFilterState(valueDict, order_by)
+        querySet, plan = self.getExportQuerySet(state)
+
+        return XLSXQuerySetSerializer(
+            columns=self.getColumns(),
+            databasePlan=plan
+        ).stream(
+            self.iterateForExport(querySet, progress),
+            self.title,
+            self.getHeader(),
+            self.describeExportData(state)
+        )
+
+    def exportToFile(self, valueDict, output_format, fileobj, progress=None):
+        """Export to a binary file object, in output_format (XLS, XLSX or
+        CSV); see datable.web.jobs. Returns the number of exported rows.
+        """
+        exported = [0]
+
+        def count(rows):
+            exported[0] = rows
+            if progress is not None:
+                progress(rows)
+
+        if output_format == formats.XLS:
+            shutil.copyfileobj(
+                self.serializeToXLS(valueDict, progress=count), fileobj)
+        elif output_format == formats.XLSX:
+            for chunk in self.streamToXLSX(valueDict, progress=count):
+                fileobj.write(chunk)
+        elif output_format == formats.CSV:
+            for chunk in self.streamToCSV(valueDict, progress=count):
+                fileobj.write(chunk)
+        else:
+            raise formats.UnknownFormat(output_format)
+
+        return exported[0]
+
+    async def aserializeToCSV(self, valueDict, order_by=None):
+        return await aio.runSync(self.serializeToCSV, valueDict, order_by)
+
+    def astreamToCSV(self, valueDict, order_by=None):
+        """streamToCSV for asyncio: returns an async iterator of chunks."""
+        return aio.aiterate(self.streamToCSV(valueDict, order_by))
+
+    async def aserializeToXLS(self, valueDict, order_by=None):
+        return await aio.runSync(self.serializeToXLS, valueDict, order_by)
+
+    def astreamToXLSX(self, valueDict, order_by=None):
+        return aio.aiterate(self.streamToXLSX(valueDict, order_by))
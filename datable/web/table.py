@@ -1,22 +1,63 @@
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
 from django.http import Http404
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5: a plain HttpResponse will consume an iterator lazily
+    StreamingHttpResponse = HttpResponse
+
+try:
+    from django.http import FileResponse
+except ImportError:
+    # Django < 1.7.4
+    FileResponse = None
+
 from dojango.decorators import json_response
 from django.utils.translation import ugettext as _
 
 from datable.core import formats
+from datable.web import aio
+from datable.web import exportcache
+from datable.web import jobs
+from datable.web.util import etagMatches
+from datable.web.util import parseRange
 from datetime import datetime
 from urllib.parse import urlencode
+from wsgiref.util import FileWrapper
+
+import os
+
+def readRange(path, start, length, blockSize=65536):
+    """Yield length bytes of a file, from start."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(blockSize, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+
 
 class Table(object):
-    """A table, which may be presented as JSON or XLS or CSV.
+    """A table, which may be presented as JSON or XLS, XLSX or CSV.
     """
 
     filename = None
     columns = None
     widgets = None
     primaryKeySerializer = None
+    streaming = False  # stream CSV exports instead of buffering them
+    # Both keep files in the DATABLE_EXPORT_DIR setting's directory
+    backgroundExports = False  # export in background jobs (datable.web.jobs)
+    cacheExports = False  # keep exported files (datable.web.exportcache)
+    frozen = False  # set by freeze()
 
-    def __init__(self, name, storage, filename=None, objectpath=None):
+    def __init__(self, name, storage, filename=None, objectpath=None,
+                 streaming=None, backgroundExports=None,
+                 cacheExports=None):
         self.name = name
         self.objectpath = objectpath
         self.storage = storage
@@ -24,10 +65,44 @@ class Table(object):
         if filename is not None:
             self.filename = filename
 
+        if streaming is not None:
+            self.streaming = streaming
+
+        if backgroundExports is not None:
+            self.backgroundExports = backgroundExports
+
+        if cacheExports is not None:
+            self.cacheExports = cacheExports
+
+        self.storage.setDefaultCacheName(self.getCacheName())
+
         if self.filename is None:
             self.filename = self.name
 
 
+    def getCacheName(self):
+        """Default Storage.cacheName: the table's name and the model, as
+        tables of different pages may share a name."""
+        model = getattr(self.storage.querySet, 'model', None)
+        if model is None:
+            return self.name
+        return '%s,%s.%s' % (
+            self.name, model._meta.app_label, model._meta.object_name)
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError("%s is frozen, it can not be changed" % self)
+        self.__dict__[name] = value
+
+    def freeze(self):
+        """Validate this table and its storage, and make both immutable;
+        see datable.web.registry."""
+        self.storage.freeze()
+        self.frozen = True
+
+    def __repr__(self):
+        return '<Table %s>' % self.name
+
     def getSortColumn(self, requestDict):
         real_name = requestDict.get('sort', None)
 
@@ -40,33 +115,194 @@ class Table(object):
             desc = True
             real_name = real_name[1:]
 
-        for column in self.storage.getColumns():
-            if real_name == column.getName():
-                return column, desc
+        column = self.storage.getColumn(real_name)
+        if column is None:
+            return
 
-        return
+        return column, desc
 
     def filterAndSort(self, request, method="GET"):
         """This function performs filtering and sorting of a QuerySet,
         based on settings found in request, sent by method (POST, GET)"""
+        state = self.getFilterState(request, method)
+        return self.storage.filterAndSort(state)
+
+    def getFilterState(self, request, method="GET"):
+        """Parse the request once; see datable.web.state.FilterState"""
         requestDict = getattr(request, method)
-        sortColumn = self.getSortColumn(requestDict)
-        return self.storage.filterAndSort(requestDict, sortColumn)
+        order_by = self.getSortColumn(requestDict)
+        return self.storage.getFilterState(requestDict, order_by)
 
     def getExportFilename(self, output_format):
         fn = "%s.%s" % (self.filename, formats.getExtension(output_format))
-        fn = datetime.now().strftime(fn.encode('utf-8')).replace(" ", "_")
+        fn = datetime.now().strftime(fn).replace(" ", "_")
         return urlencode([('filename', fn)])
 
     def fileResponse(self, fobj, output_format):
         # XXX: TODO: memory-intensive
         data = fobj.read()
-        response = HttpResponse(data, mimetype=formats.getMimetype(output_format))
+        response = HttpResponse(
+            data, content_type=formats.getMimetype(output_format))
         cd = 'attachment; %s' % self.getExportFilename(output_format)
         response['Content-Disposition'] = cd
         response['Content-Length'] = len(data)
         return response
 
+    def streamingResponse(self, chunks, output_format):
+        """Send chunks to the client as they are generated. There is no
+        Content-Length header, as the size is not known up front."""
+        response = StreamingHttpResponse(
+            chunks, content_type=formats.getMimetype(output_format))
+        cd = 'attachment; %s' % self.getExportFilename(output_format)
+        response['Content-Disposition'] = cd
+        return response
+
+    def downloadResponse(self, request, path, output_format, etag=None):
+        """Send a file from disk without reading it into memory; with
+        FileResponse, the server may use sendfile. A Range request gets
+        a part of the file, so broken downloads can be resumed; etag
+        identifies the file's content for If-Range."""
+        size = os.path.getsize(path)
+        contentType = formats.getMimetype(output_format)
+
+        byteRange = parseRange(request.META.get('HTTP_RANGE'), size)
+        ifRange = request.META.get('HTTP_IF_RANGE')
+        if ifRange and (etag is None or not etagMatches(ifRange, etag)):
+            # The file changed since the client got its part
+            byteRange = None
+
+        if byteRange is None:
+            if FileResponse is not None:
+                response = FileResponse(
+                    open(path, 'rb'), content_type=contentType)
+            else:
+                response = StreamingHttpResponse(
+                    FileWrapper(open(path, 'rb')), content_type=contentType)
+            response['Content-Length'] = size
+
+        elif byteRange[0] >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%i' % size
+            return response
+
+        else:
+            first, last = byteRange
+            response = StreamingHttpResponse(
+                readRange(path, first, last - first + 1),
+                content_type=contentType, status=206)
+            response['Content-Range'] = 'bytes %i-%i/%i' % (
+                first, last, size)
+            response['Content-Length'] = last - first + 1
+
+        response['Accept-Ranges'] = 'bytes'
+        if etag is not None:
+            response['ETag'] = '"%s"' % etag
+        cd = 'attachment; %s' % self.getExportFilename(output_format)
+        response['Content-Disposition'] = cd
+        return response
+
+    def cachedExportResponse(self, request, state, output_format):
+        """Send an export from the export cache, exporting it first when
+        it is not there; see datable.web.exportcache."""
+        key = exportcache.getKey(self.storage, state, output_format)
+        path = exportcache.fetch(self.storage, state, output_format, key)
+        return self.downloadResponse(request, path, output_format, key)
+
+    def jobResponse(self, request, param, state, requestDict):
+        """Start an export job, report its progress or send its file;
+        see datable.web.jobs."""
+        if param == 'job':
+            try:
+                output_format = formats.getFormat(requestDict.get('export'))
+                return self.jsonResponse(
+                    jobs.start(self, state, output_format))
+            except formats.UnknownFormat:
+                raise Http404
+
+        jobState = jobs.readState(requestDict.get('job'))
+        if jobState is None or jobState['table'] != self.name:
+            raise Http404
+
+        if param == 'jobstatus':
+            return self.jsonResponse(jobState)
+
+        result = jobs.getFile(jobState['id'])
+        if result is None:
+            raise Http404
+
+        path, output_format = result
+        return self.downloadResponse(
+            request, path, output_format,
+            jobState.get('key') or jobState['id'])
+
+    def conditionalJSONResponse(self, request, state):
+        """JSON page for state, or 304 Not Modified, if the client has it
+        already. The ETag of Storage.getValidator is checked before the
+        page is fetched; without one, the ETag is computed from the
+        serialized page, which saves sending it only."""
+        if self.usesSyncToken(state):
+            # Delta responses depend on the token, they are not validated
+            return self.jsonResponse(self.storage.serializeToJSON(state))
+
+        header = request.META.get('HTTP_IF_NONE_MATCH')
+
+        # The rows counted for the ETag are not counted again
+        etag, counted = self.storage.getValidator(state)
+        if etag is not None and etagMatches(header, etag):
+            return self.notModifiedResponse(etag)
+
+        data = self.storage.serializeToJSON(state, counted=counted)
+        return self.validatedJSONResponse(header, state, data, etag)
+
+    async def aconditionalJSONResponse(self, request, state):
+        if self.usesSyncToken(state):
+            return self.jsonResponse(
+                await self.storage.aserializeToJSON(state))
+
+        header = request.META.get('HTTP_IF_NONE_MATCH')
+
+        etag, counted = await aio.runSync(self.storage.getValidator, state)
+        if etag is not None and etagMatches(header, etag):
+            return self.notModifiedResponse(etag)
+
+        data = await self.storage.aserializeToJSON(state, counted=counted)
+        return self.validatedJSONResponse(header, state, data, etag)
+
+    def usesSyncToken(self, state):
+        """Did the client send a sync token for a delta refresh? Only
+        checked for storages with delta refreshes enabled."""
+        return self.storage.deltaTimeout is not None and \
+            state.syncToken is not None
+
+    def validatedJSONResponse(self, header, state, data, etag=None):
+        if etag is None:
+            etag = self.storage.getDataETag(state, data)
+            if etagMatches(header, etag):
+                return self.notModifiedResponse(etag)
+
+        response = self.jsonResponse(data)
+        self.setValidators(response, etag)
+        return response
+
+    def setValidators(self, response, etag):
+        response['ETag'] = '"%s"' % etag
+        # The browser may keep the response, but has to revalidate it
+        response['Cache-Control'] = 'no-cache'
+
+    def notModifiedResponse(self, etag):
+        response = HttpResponseNotModified()
+        self.setValidators(response, etag)
+        return response
+
+    def eventResponse(self, events):
+        """A response streaming Server-Sent Events."""
+        response = StreamingHttpResponse(
+            events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Do not let nginx buffer the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
     def willHandle(self, request, method="GET"):
         """Will this datable handle this request?"""
         requestDict = getattr(request, method)
@@ -79,44 +315,130 @@ class Table(object):
 
     def handleRequest(self, request, method="GET"):
         requestDict = getattr(request, method)
-        order_by = self.getSortColumn(requestDict)
+        state = self.getFilterState(request, method)
 
         param = requestDict.get(self.name)
 
         if param == 'json':
-            return self.jsonResponse(
-                self.storage.serializeToJSON(requestDict, order_by)
-                )
+            return self.conditionalJSONResponse(request, state)
+
+        elif param == 'probe':
+            return self.jsonResponse(self.storage.probe(state))
+
+        elif param == 'events' and self.storage.pushEvents:
+            return self.eventResponse(self.storage.streamEvents(state))
+
+        elif param in ('job', 'jobstatus', 'jobfile') and \
+                self.backgroundExports:
+            return self.jobResponse(request, param, state, requestDict)
+
+        elif param in ('xls', 'xlsx', 'csv') and self.cacheExports:
+            return self.cachedExportResponse(
+                request, state, formats.getFormat(param))
 
         elif param == 'xls':
             return self.fileResponse(
-                self.storage.serializeToXLS(requestDict, order_by),
+                self.storage.serializeToXLS(state),
                 formats.XLS)
 
+        elif param == 'xlsx':
+            return self.streamingResponse(
+                self.storage.streamToXLSX(state),
+                formats.XLSX)
+
         elif param == 'csv':
+            if self.streaming:
+                return self.streamingResponse(
+                    self.storage.streamToCSV(state),
+                    formats.CSV)
+
             return self.fileResponse(
-                self.storage.serializeToCSV(requestDict, order_by),
+                self.storage.serializeToCSV(state),
                 formats.CSV)
 
         elif param.startswith('widget,'):
-            widgetName = param.split(",")[1]
-            w = self.storage.getWidget(widgetName)
-            if not w:
-                raise Http404
+            other_storage, valueDict = self.getWidgetRequest(
+                param, requestDict)
+            return self.jsonResponse(
+                other_storage.serializeToJSON(valueDict, None))
 
-            other_storage = w.getStorage()
+        raise Http404
 
-            if not other_storage:
-                raise Http404
+    async def ahandleRequest(self, request, method="GET"):
+        """handleRequest for asyncio (ASGI) views.
+        """
+        requestDict = getattr(request, method)
+        state = self.getFilterState(request, method)
+
+        param = requestDict.get(self.name)
 
-            valueDict = dict(list(requestDict.items()))
-            valueDict.pop(self.name)
-            if 'sort' in valueDict:
-                valueDict.pop('sort')
+        if param == 'json':
+            return await self.aconditionalJSONResponse(request, state)
+
+        elif param == 'probe':
+            return self.jsonResponse(
+                await aio.runSync(self.storage.probe, state))
+
+        elif param == 'events' and self.storage.pushEvents:
+            return self.eventResponse(self.storage.astreamEvents(state))
+
+        elif param in ('job', 'jobstatus', 'jobfile') and \
+                self.backgroundExports:
+            return await aio.runSync(
+                self.jobResponse, request, param, state, requestDict)
+
+        elif param in ('xls', 'xlsx', 'csv') and self.cacheExports:
+            return await aio.runSync(
+                self.cachedExportResponse,
+                request, state, formats.getFormat(param))
 
-            return self.jsonResponse(other_storage.serializeToJSON(valueDict, None))
+        elif param == 'xls':
+            return self.fileResponse(
+                await self.storage.aserializeToXLS(state),
+                formats.XLS)
+
+        elif param == 'xlsx':
+            return self.streamingResponse(
+                self.storage.astreamToXLSX(state),
+                formats.XLSX)
+
+        elif param == 'csv':
+            if self.streaming:
+                return self.streamingResponse(
+                    self.storage.astreamToCSV(state),
+                    formats.CSV)
+
+            return self.fileResponse(
+                await self.storage.aserializeToCSV(state),
+                formats.CSV)
+
+        elif param.startswith('widget,'):
+            other_storage, valueDict = self.getWidgetRequest(
+                param, requestDict)
+            return self.jsonResponse(
+                await other_storage.aserializeToJSON(valueDict, None))
 
         raise Http404
 
+    def getWidgetRequest(self, param, requestDict):
+        """For a 'widget,name' request, find the widget's storage and
+        the values to filter it with."""
+        widgetName = param.split(",")[1]
+        w = self.storage.getWidget(widgetName)
+        if not w:
+            raise Http404
+
+        other_storage = w.getStorage()
+
+        if not other_storage:
+            raise Http404
+
+        valueDict = dict(list(requestDict.items()))
+        valueDict.pop(self.name)
+        if 'sort' in valueDict:
+            valueDict.pop('sort')
+
+        return other_storage, valueDict
+
     def getStorage(self):
         return self.storage
@@ -1,3 +1,30 @@
+import os
+
+import django
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import ManyToManyField
+
+try:
+    from django.core.exceptions import FieldDoesNotExist
+except ImportError:
+    # Django < 1.8
+    from django.db.models.fields import FieldDoesNotExist
+
+try:
+    from django.db.models import prefetch_related_objects
+except ImportError:
+    # Django < 1.10: takes a list of lookups
+    from django.db.models.query import prefetch_related_objects as _prefetch
+
+    def prefetch_related_objects(models, *lookups):
+        _prefetch(models, list(lookups))
+
+# Since Django 4.1, QuerySet.iterator(chunk_size=...) runs prefetch_related
+# lookups for every chunk; before, it ignores them.
+ITERATOR_PREFETCHES = django.VERSION >= (4, 1)
+
 
 def getFullPath(request):
     """Get full URL path from the request
@@ -7,3 +34,185 @@ def getFullPath(request):
     full_path = ('http', ('', 's')[request.is_secure()], \
                  '://', host, request.path)
     return ''.join(full_path)
+
+
+def etagMatches(header, etag):
+    """Does an If-None-Match header match the (unquoted) etag?
+    """
+    if not header:
+        return False
+
+    for value in header.split(','):
+        value = value.strip()
+        if value == '*':
+            return True
+        if value.startswith('W/'):
+            value = value[2:]
+        if value.strip('"') == etag:
+            return True
+
+    return False
+
+
+def parseRange(header, size):
+    """The (first, last) byte positions of a single-range Range header,
+    like 'bytes=0-499', for a file of size bytes. first may be size or
+    more, when the range can not be satisfied. None if there is no
+    header, it is not understood or it asks for many ranges; the whole
+    file should be sent then.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            # The last bytes
+            length = int(last)
+            if length <= 0:
+                return size, size - 1
+            return max(size - length, 0), size - 1
+
+        first = int(first)
+        if last:
+            last = min(int(last), size - 1)
+        else:
+            last = size - 1
+    except ValueError:
+        return None
+
+    if first < 0 or (last < first and first < size):
+        return None
+    return first, last
+
+
+def resolveFieldPath(model, path):
+    """Find the model field, pointed by a QuerySet lookup path like
+    'book_type__name'. Returns None if the path does not lead to a concrete,
+    single-valued field.
+    """
+    parts = path.split('__')
+    field = None
+
+    for no, name in enumerate(parts):
+        if field is not None:
+            rel = getattr(field, 'remote_field', None) or \
+                getattr(field, 'rel', None)
+            model = getattr(rel, 'model', None) or getattr(rel, 'to', None)
+            if model is None:
+                return None
+
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+        if isinstance(field, ManyToManyField) or \
+           not getattr(field, 'concrete', True):
+            return None
+
+    return field
+
+
+def getRelatedModel(field):
+    """The model a relation field (or a reverse relation) points to,
+    or None for other fields."""
+    related = getattr(field, 'related_model', None)
+    if related is not None:
+        return related
+
+    # Django < 1.8
+    rel = getattr(field, 'rel', None)
+    if rel is not None:
+        return getattr(rel, 'to', None)
+    if getattr(field, 'field', None) is not None:
+        return getattr(field, 'model', None)
+
+
+def getRelatedModels(model, path):
+    """Models reached by following a QuerySet lookup path (or a path used
+    with select_related or prefetch_related) from model, in order. Unknown
+    names end the path."""
+    result = []
+
+    for name in path.split('__'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            if not name.endswith('_set'):
+                break
+            # The default accessor of a reverse relation
+            try:
+                field = model._meta.get_field(name[:-len('_set')])
+            except FieldDoesNotExist:
+                break
+
+        model = getRelatedModel(field)
+        if model is None:
+            break
+        result.append(model)
+
+    return result
+
+
+class ChunkedIterator:
+    """Iterate over a QuerySet through a server-side cursor, fetching
+    chunkSize rows at a time and without filling the QuerySet's result
+    cache. I count fetched rows and chunks.
+    """
+
+    def __init__(self, querySet, chunkSize):
+        self.querySet = querySet
+        self.chunkSize = chunkSize
+        self.rows = 0
+        self.chunks = 0
+
+    def iterator(self):
+        try:
+            return self.querySet.iterator(chunk_size=self.chunkSize)
+        except TypeError:
+            # Django < 2.0: no chunk_size parameter
+            return self.querySet.iterator()
+
+    def __iter__(self):
+        for model in self.iterator():
+            if self.rows % self.chunkSize == 0:
+                self.chunks += 1
+            self.rows += 1
+            yield model
+
+
+def prefetchInChunks(models, lookups, chunkSize):
+    """Run prefetch_related lookups for models, chunkSize models at a
+    time, where QuerySet.iterator() does not (see ITERATOR_PREFETCHES).
+    """
+    chunk = []
+    for model in models:
+        chunk.append(model)
+        if len(chunk) == chunkSize:
+            prefetch_related_objects(chunk, *lookups)
+            for model in chunk:
+                yield model
+            chunk = []
+
+    if chunk:
+        prefetch_related_objects(chunk, *lookups)
+        for model in chunk:
+            yield model
+
+
+def getExportDirectory(name, directory=None):
+    """Directory for exported files: directory, or name in the
+    DATABLE_EXPORT_DIR setting. Exports contain the tables' data, so there
+    is no default in a shared place like the temporary directory. Created
+    directories are private to the user."""
+    if directory is None:
+        base = getattr(settings, 'DATABLE_EXPORT_DIR', None)
+        if not base:
+            raise ImproperlyConfigured(
+                "Set DATABLE_EXPORT_DIR to a private directory, in which "
+                "exported files are kept")
+        directory = os.path.join(base, name)
+
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return directory
@@ -13,6 +13,8 @@ from datable.core.filters import DateFilter
 from datable.core.filters import DateTimeFilter
 from datable.core.filters import StringFilter
 
+from datable.web.state import FilterState
+
 
 Minimum = 'min'
 
@@ -107,24 +109,42 @@ class Widget:
     def existsIn(self, requestDict):
         """Does this widget exists in the requestDict?
         """
+        if isinstance(requestDict, FilterState):
+            return self.getName() in requestDict
         return self.converter.existsIn(requestDict)
 
+    def getValue(self, requestDict):
+        """Converted value of this widget in the requestDict. Storage
+        passes a FilterState as the requestDict, which holds values
+        converted already.
+        """
+        if isinstance(requestDict, FilterState):
+            return requestDict[self.getName()]
+        return self.converter.valueFromJS(requestDict)
+
     def exportDescription(self, requestDict):
         """Get export description of this field.
         This is used when rendering a file with export data and we want to
         display a description of filters used in the file"""
 
         if self.existsIn(requestDict):
-            return [self.label, self.converter.valueFromJS(requestDict)]
+            return self.describeValue(self.getValue(requestDict))
+
+    def describeValue(self, value):
+        """exportDescription for an already converted value."""
+        return [self.label, value]
 
     def filterQuerySet(self, querySet, requestDict):
         """Perfom filtering, using this widget's value
         """
         if self.existsIn(requestDict):
-            value = self.converter.valueFromJS(requestDict)
-            return self.filter.filterQuerySet(querySet, value)
+            return self.filterValue(querySet, self.getValue(requestDict))
         return querySet
 
+    def filterValue(self, querySet, value):
+        """filterQuerySet for an already converted value."""
+        return self.filter.filterQuerySet(querySet, value)
+
     def getName(self):
         return self.name
 
@@ -2,7 +2,7 @@ from datetime import datetime
 from django.shortcuts import redirect
 
 from django.shortcuts import render_to_response
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext_lazy as _
 from datable.web.columns import HrefColumn
 from datable.web.columns import ImageColumn
 
@@ -11,6 +11,7 @@ from datable.core.serializers import URLSerializer
 
 from django.db.models import Q
 
+from datable.web import registry
 from datable.web.table import Table
 from datable.web.storage import Storage
 
@@ -49,13 +50,18 @@ from test_app import models
 class AuthorsSerializer(UnicodeSerializer):
     """This is an implementation of a custom field serializer for a
     M2M relations with 'through'. In this example, what matters to us is
-    the order of authors.
+    the order of authors. The relation is prefetched, so we sort
+    in Python instead of running a query for every book.
     """
 
+    prefetchRelated = ('bookauthor_set__author', )
+    requiredFields = ()
+
     def serialize(self, model, output_format=None):
         return ", ".join([
-            str(author)
-            for author in model.authors.all().order_by('bookauthor__sort_order')
+            str(bookauthor.author)
+            for bookauthor in sorted(
+                model.bookauthor_set.all(), key=lambda x: x.sort_order)
             ])
 
 
@@ -67,9 +73,12 @@ class AuthorStorageFilter(StringFilter):
             )
 
 
-def books_demo(request):
+# Tables are built once, when first needed, and shared by all requests;
+# labels are translated lazily, when displayed.
 
-    first_table = Table(
+@registry.table('books_demo')
+def booksTable():
+    return Table(
         name='first_table',
 
         storage=Storage(
@@ -141,6 +150,10 @@ def books_demo(request):
         filename=_("My important export data %Y-%m-%d")
         )
 
+
+def books_demo(request):
+    first_table = registry.get('books_demo')
+
     if first_table.willHandle(request):
         return first_table.handleRequest(request)
 
@@ -148,8 +161,9 @@ def books_demo(request):
         "books.html", {'first_table': first_table})
 
 
-def authors_demo(request):
-    first_table = Table(
+@registry.table('authors_demo')
+def authorsTable():
+    return Table(
         name='first_table',
 
         storage=Storage(
@@ -198,6 +212,10 @@ def authors_demo(request):
         filename=_("My important export data %Y-%m-%d")
         )
 
+
+def authors_demo(request):
+    first_table = registry.get('authors_demo')
+
     if first_table.willHandle(request):
         return first_table.handleRequest(request)
 
@@ -205,8 +223,9 @@ def authors_demo(request):
         "authors.html", {'first_table': first_table})
 
 
-def images_demo(request):
-    imageTable = Table(
+@registry.table('images_demo')
+def imagesTable():
+    return Table(
         name='imageTable',
 
         storage=Storage(
@@ -228,6 +247,10 @@ def images_demo(request):
         ),
     )
 
+
+def images_demo(request):
+    imageTable = registry.get('images_demo')
+
     if imageTable.willHandle(request):
         return imageTable.handleRequest(request)
 